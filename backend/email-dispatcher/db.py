@@ -0,0 +1,293 @@
+'''
+Пул соединений с PostgreSQL, переживающий тёплые вызовы функции.
+Соединение проверяется перед повторной выдачей, сломанные соединения
+пересоздаются, горячие запросы готовятся (PREPARE) один раз на соединение.
+psycopg2 импортируется при первом обращении к базе, а не при импорте модуля,
+чтобы OPTIONS и прочие ответы без БД не платили за него на холодном старте.
+Курсоры по умолчанию RealDictCursor. NUMERIC читается сразу как float (NUMERIC_AS_FLOAT),
+чтобы цены и суммы сериализовались orjson без callback на каждое значение;
+арифметику с деньгами вызывающий код ведёт в Decimal сам.
+
+Если задан DATABASE_READ_URL, чтения (connection(readonly=True)) идут на реплику,
+пока она доступна и её отставание не больше DB_REPLICA_MAX_LAG секунд; иначе на primary.
+Для чтения своих записей запись возвращает позицию WAL (write_position), и чтение
+с read_after уходит на реплику, только если она эту позицию уже применила.
+'''
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import tracing
+
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '5'))
+POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', '1800'))
+REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', '5'))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', '5'))
+REPLICA_RETRY_AFTER = float(os.environ.get('DB_REPLICA_RETRY_AFTER', '30'))
+
+READ_AFTER_HEADER = 'X-Read-After'
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+
+REPLICA_LAG_QUERY = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END::float8 AS lag
+'''
+
+REPLICA_CAUGHT_UP_QUERY = '''
+    SELECT coalesce(pg_last_wal_replay_lsn(), pg_current_wal_insert_lsn()) >= %s::pg_lsn AS caught_up
+'''
+
+_statements: Dict[str, str] = {}
+_connection_class: Optional[type] = None
+
+
+def _numeric_as_float(value: Optional[str], cursor: Any) -> Optional[float]:
+    return float(value) if value is not None else None
+
+
+def connection_class() -> type:
+    '''Класс соединения пула; создаётся при первом подключении вместе с импортом psycopg2'''
+    global _connection_class
+    if _connection_class is None:
+        import psycopg2.extensions
+        from psycopg2.extras import RealDictCursor
+
+        numeric_as_float = psycopg2.extensions.new_type(
+            psycopg2.extensions.DECIMAL.values, 'NUMERIC_AS_FLOAT', _numeric_as_float
+        )
+
+        class PooledConnection(psycopg2.extensions.connection):
+            '''Соединение, помнящее время создания, последнего использования и подготовленные запросы'''
+
+            def __init__(self, *args: Any, **kwargs: Any) -> None:
+                super().__init__(*args, **kwargs)
+                psycopg2.extensions.register_type(numeric_as_float, self)
+                self.cursor_factory = RealDictCursor
+                self.created_at = time.monotonic()
+                self.released_at = self.created_at
+                self.prepared: set = set()
+                self.replica = False
+
+            def cursor(self, *args: Any, **kwargs: Any) -> Any:
+                if tracing.current() is not None:
+                    kwargs['cursor_factory'] = tracing.traced_cursor(
+                        kwargs.get('cursor_factory') or self.cursor_factory
+                    )
+                return super().cursor(*args, **kwargs)
+
+        _connection_class = PooledConnection
+    return _connection_class
+
+
+class ConnectionPool:
+    def __init__(self, dsn_env: str = 'DATABASE_URL', max_size: int = POOL_MAX_SIZE) -> None:
+        self.dsn_env = dsn_env
+        self.max_size = max_size
+        self._idle: List[Any] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _connect(self) -> Any:
+        import psycopg2
+        conn = psycopg2.connect(os.environ[self.dsn_env], connection_factory=connection_class())
+        conn.replica = self is _read_pool
+        return conn
+
+    def _is_usable(self, conn: Any) -> bool:
+        import psycopg2.extensions
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if now - conn.created_at > POOL_MAX_LIFETIME:
+            return False
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if now - conn.released_at > POOL_CHECK_AFTER:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def acquire(self) -> Any:
+        if not self._slots.acquire(timeout=POOL_ACQUIRE_TIMEOUT):
+            from psycopg2.pool import PoolError
+            raise PoolError('connection pool exhausted')
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    return self._connect()
+                if self._is_usable(conn):
+                    return conn
+                _close_quietly(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn: Any, broken: bool = False) -> None:
+        import psycopg2
+        try:
+            if broken or conn.closed:
+                _close_quietly(conn)
+                return
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                _close_quietly(conn)
+                return
+            conn.released_at = time.monotonic()
+            with self._lock:
+                self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            _close_quietly(conn)
+
+
+def _close_quietly(conn: Any) -> None:
+    import psycopg2
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+class ReplicaHealth:
+    '''Состояние реплики в этом экземпляре: отставание проверяется не чаще REPLICA_CHECK_INTERVAL'''
+
+    def __init__(self) -> None:
+        self.down_until = 0.0
+        self.checked_at = 0.0
+        self.lagging = False
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def mark_down(self) -> None:
+        self.down_until = time.monotonic() + REPLICA_RETRY_AFTER
+        self.checked_at = 0.0
+
+    def accepts(self, conn: Any, read_after: Optional[str]) -> bool:
+        '''Можно ли читать с этого соединения реплики: отставание в норме и позиция read_after применена'''
+        now = time.monotonic()
+        with conn.cursor() as cursor:
+            if now - self.checked_at > REPLICA_CHECK_INTERVAL:
+                cursor.execute(REPLICA_LAG_QUERY)
+                self.lagging = cursor.fetchone()['lag'] > REPLICA_MAX_LAG
+                self.checked_at = now
+            if self.lagging:
+                return False
+            if read_after:
+                cursor.execute(REPLICA_CAUGHT_UP_QUERY, (read_after,))
+                return cursor.fetchone()['caught_up']
+        return True
+
+
+_pool = ConnectionPool()
+_read_pool = ConnectionPool('DATABASE_READ_URL') if os.environ.get('DATABASE_READ_URL') else None
+_replica = ReplicaHealth()
+
+
+def _acquire_replica(read_after: Optional[str]) -> Optional[Any]:
+    '''
+    Соединение с репликой или None, если реплика недоступна, отстаёт или ещё не дошла до read_after.
+    Исчерпанный пул реплики не считается её отказом: чтение уходит на primary только в этот раз.
+    '''
+    import psycopg2
+    from psycopg2.pool import PoolError
+    if _read_pool is None or not _replica.available():
+        return None
+    try:
+        conn = _read_pool.acquire()
+    except PoolError:
+        return None
+    except psycopg2.Error:
+        _replica.mark_down()
+        return None
+    try:
+        if _replica.accepts(conn, read_after):
+            return conn
+        _read_pool.release(conn)
+    except psycopg2.Error:
+        _replica.mark_down()
+        _read_pool.release(conn, broken=True)
+    return None
+
+
+@contextmanager
+def connection(readonly: bool = False, read_after: Optional[str] = None) -> Iterator[Any]:
+    '''
+    Выдаёт соединение из пула и возвращает его обратно.
+    readonly=True разрешает чтение с реплики (см. описание модуля), conn.replica
+    показывает, куда ушёл запрос. Незафиксированная транзакция откатывается;
+    соединение, на котором случилась ошибка связи, закрывается и не возвращается в пул.
+    '''
+    with tracing.phase('db_connect'):
+        conn = _acquire_replica(read_after) if readonly else None
+        pool = _read_pool if conn is not None else _pool
+        if conn is None:
+            conn = _pool.acquire()
+    import psycopg2
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        if conn.replica:
+            _replica.mark_down()
+        raise
+    finally:
+        pool.release(conn, broken=broken)
+
+
+def parse_read_after(raw: Optional[str]) -> Optional[str]:
+    '''Позиция WAL из заголовка X-Read-After; некорректное значение игнорируется'''
+    raw = (raw or '').strip()
+    return raw if LSN_PATTERN.match(raw) else None
+
+
+def write_position(cursor: Any) -> Optional[str]:
+    '''Позиция WAL на primary после коммита записи; без реплики не запрашивается'''
+    if _read_pool is None:
+        return None
+    cursor.execute('SELECT pg_current_wal_insert_lsn()::text AS lsn')
+    return cursor.fetchone()['lsn']
+
+
+def read_after_headers(position: Optional[str]) -> Dict[str, str]:
+    '''Заголовки ответа на запись, по которым клиент прочитает свою запись с реплики'''
+    if position is None:
+        return {}
+    return {READ_AFTER_HEADER: position, 'Access-Control-Expose-Headers': READ_AFTER_HEADER}
+
+
+def register_statement(name: str, sql: str) -> None:
+    '''Регистрирует горячий запрос; он будет подготовлен при первом использовании на каждом соединении'''
+    _statements[name] = sql
+
+
+def execute_prepared(cursor: Any, name: str, params: Optional[Sequence[Any]] = None) -> None:
+    conn = cursor.connection
+    if name not in conn.prepared:
+        cursor.execute(f'PREPARE {name} AS {_statements[name]}')
+        conn.prepared.add(name)
+    if params:
+        placeholders = ', '.join(['%s'] * len(params))
+        cursor.execute(f'EXECUTE {name} ({placeholders})', tuple(params))
+    else:
+        cursor.execute(f'EXECUTE {name}')
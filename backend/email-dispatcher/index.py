@@ -0,0 +1,165 @@
+import json
+import os
+from typing import Dict, Any, List
+
+import db
+import tracing
+from responses import json_response
+
+SEND_EMAIL_URL = os.environ.get('SEND_EMAIL_URL', 'https://functions.poehali.dev/send-email')
+BATCH_SIZE = int(os.environ.get('EMAIL_DISPATCH_BATCH_SIZE', '50'))
+MAX_BATCH_SIZE = int(os.environ.get('EMAIL_DISPATCH_MAX_BATCH_SIZE', '100'))
+SEND_BUDGET = float(os.environ.get('EMAIL_SEND_BUDGET', '120'))
+SEND_TIMEOUT = float(os.environ.get('EMAIL_SEND_TIMEOUT', '300'))
+MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', '8'))
+BACKOFF_BASE = int(os.environ.get('EMAIL_BACKOFF_BASE', '30'))
+BACKOFF_MAX = int(os.environ.get('EMAIL_BACKOFF_MAX', '3600'))
+LEASE_SECONDS = int(os.environ.get('EMAIL_LEASE_SECONDS', '360'))
+
+OPTIONS_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': ''
+}
+
+METHOD_NOT_ALLOWED_RESPONSE = json_response(405, {'error': 'Method not allowed'})
+
+CLAIM_BATCH = '''
+    UPDATE email_outbox 
+    SET next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+    WHERE id IN (
+        SELECT id FROM email_outbox
+        WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+        ORDER BY next_attempt_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, to_email, subject, html, attempts
+'''
+
+RECORD_RESULTS = '''
+    UPDATE email_outbox o
+    SET status = v.status,
+        attempts = v.attempts,
+        last_error = v.last_error,
+        sent_at = CASE WHEN v.status = 'sent' THEN CURRENT_TIMESTAMP ELSE o.sent_at END,
+        next_attempt_at = CASE
+            WHEN v.retry_in IS NOT NULL THEN CURRENT_TIMESTAMP + make_interval(secs => v.retry_in)
+            ELSE o.next_attempt_at
+        END
+    FROM (VALUES %s) AS v(id, status, attempts, last_error, retry_in)
+    WHERE o.id = v.id
+'''
+
+@tracing.traced
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Разбор очереди email_outbox пачками с повторами и dead-letter
+    Args: event - вызов по таймеру или HTTP POST (queryStringParameters: batch_size до MAX_BATCH_SIZE)
+          context - объект с атрибутами request_id, function_name
+    Returns: HTTP response со статистикой отправки
+    '''
+    method: str = event.get('httpMethod', 'POST')
+    
+    if method == 'OPTIONS':
+        return OPTIONS_RESPONSE
+    
+    if method != 'POST':
+        return METHOD_NOT_ALLOWED_RESPONSE
+    
+    params = event.get('queryStringParameters') or {}
+    try:
+        batch_size = int(params.get('batch_size') or BATCH_SIZE)
+    except ValueError:
+        return json_response(400, {'error': 'batch_size must be an integer'})
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(CLAIM_BATCH, (LEASE_SECONDS, batch_size))
+        messages = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+    
+    with tracing.phase('send_email'):
+        results = send_batch(messages) if messages else []
+    
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        stats = record_results(cursor, results)
+        conn.commit()
+        cursor.close()
+    
+    return json_response(200, stats)
+
+def send_batch(messages: List[Dict[str, Any]]) -> List[Any]:
+    '''
+    Отправляет пачку одним вызовом send-email (одна SMTP-сессия на всю пачку).
+    send-email не начинает новые письма после time_budget секунд и успевает ответить
+    до SEND_TIMEOUT, иначе отправленные письма считались бы ошибкой и уходили повторно.
+    Возвращает пары (письмо, текст ошибки или пустая строка).
+    urllib.request (а с ним ssl и socket) импортируется здесь, чтобы не замедлять холодный старт.
+    '''
+    import urllib.error
+    import urllib.request
+    
+    request = urllib.request.Request(
+        SEND_EMAIL_URL,
+        data=json.dumps({'messages': [{
+            'id': message['id'],
+            'to': message['to_email'],
+            'subject': message['subject'],
+            'html': message['html']
+        } for message in messages], 'time_budget': SEND_BUDGET}).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=SEND_TIMEOUT) as response:
+            payload = json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        error = f'HTTP {e.code}: {e.read()[:500].decode("utf-8", "replace")}'
+        return [(message, error) for message in messages]
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+        return [(message, error) for message in messages]
+    
+    errors = {
+        result.get('id'): result.get('error') or 'unknown error'
+        for result in payload.get('results', []) if result.get('status') != 'sent'
+    }
+    sent_ids = {result.get('id') for result in payload.get('results', []) if result.get('status') == 'sent'}
+    return [
+        (message, '' if message['id'] in sent_ids else errors.get(message['id'], 'missing from send-email response'))
+        for message in messages
+    ]
+
+def backoff_seconds(attempts: int) -> int:
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+def record_results(cursor: Any, results: List[Any]) -> Dict[str, int]:
+    '''Итоги пачки одним UPDATE ... FROM (VALUES ...): sent, повтор с backoff или dead'''
+    stats = {'sent': 0, 'retried': 0, 'dead': 0}
+    rows = []
+    for message, error in results:
+        attempts = message['attempts'] + 1
+        if not error:
+            rows.append((message['id'], 'sent', attempts, None, None))
+            stats['sent'] += 1
+        elif attempts >= MAX_ATTEMPTS:
+            rows.append((message['id'], 'dead', attempts, error, None))
+            stats['dead'] += 1
+        else:
+            rows.append((message['id'], 'pending', attempts, error, backoff_seconds(attempts)))
+            stats['retried'] += 1
+    if rows:
+        from psycopg2.extras import execute_values
+        execute_values(cursor, RECORD_RESULTS, rows,
+                       template='(%s::bigint, %s::varchar, %s::int, %s::text, %s::int)',
+                       page_size=len(rows))
+    return stats
@@ -0,0 +1,103 @@
+'''
+Идемпотентность создания заказов по заголовку Idempotency-Key.
+Ключ захватывается advisory-блокировкой на время транзакции, поэтому одновременные
+повторы выполняются по очереди, и второй получает сохранённый ответ первого.
+Ответы хранятся IDEMPOTENCY_TTL_HOURS часов; просроченные ключи удаляются пачками
+не чаще раза в IDEMPOTENCY_PURGE_INTERVAL секунд на экземпляр.
+'''
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import db
+from responses import dumps
+
+KEY_HEADER = 'Idempotency-Key'
+REPLAY_HEADER = 'Idempotent-Replayed'
+KEY_PATTERN = re.compile(r'^[\x21-\x7e]{1,255}$')
+
+TTL_HOURS = float(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24'))
+PURGE_INTERVAL = float(os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', '300'))
+PURGE_BATCH_SIZE = int(os.environ.get('IDEMPOTENCY_PURGE_BATCH_SIZE', '5000'))
+
+PURGE_EXPIRED = '''
+    DELETE FROM idempotency_keys
+    WHERE key IN (
+        SELECT key FROM idempotency_keys
+        WHERE expires_at < CURRENT_TIMESTAMP
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+'''
+
+_last_purge = 0.0
+
+
+def parse_key(raw: str) -> Optional[str]:
+    '''Ключ из заголовка; пустой заголовок - None, некорректный - ValueError'''
+    raw = raw.strip()
+    if not raw:
+        return None
+    if not KEY_PATTERN.match(raw):
+        raise ValueError(f'{KEY_HEADER} must be 1-255 printable ASCII characters')
+    return raw
+
+
+def fingerprint(body_data: Any) -> str:
+    '''Хеш тела запроса: тот же ключ с другим телом - ошибка клиента, а не повтор'''
+    return hashlib.sha256(json.dumps(body_data, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def acquire(cursor: Any, key: str, request_hash: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+    '''
+    Блокирует ключ до конца транзакции и возвращает сохранённый (status_code, response),
+    если запрос с этим ключом уже выполнен. Для ключа с другим телом - ValueError.
+    '''
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtextextended('idempotency:' || %s, 0))", (key,))
+    return lookup(cursor, key, request_hash)
+
+
+def lookup(cursor: Any, key: str, request_hash: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+    '''Сохранённый ответ без блокировки - чтобы отдать повтор до списания лимитов'''
+    cursor.execute('''
+        SELECT request_hash, status_code, response
+        FROM idempotency_keys
+        WHERE key = %s AND expires_at > CURRENT_TIMESTAMP
+    ''', (key,))
+    stored = cursor.fetchone()
+    if stored is None:
+        return None
+    if stored['request_hash'] != request_hash:
+        raise ValueError(f'{KEY_HEADER} was already used with a different request')
+    return stored['status_code'], stored['response']
+
+
+def remember(cursor: Any, key: str, request_hash: str, status_code: int, payload: Dict[str, Any]) -> None:
+    '''Сохраняет ответ в той же транзакции, что и заказ'''
+    cursor.execute('''
+        INSERT INTO idempotency_keys (key, request_hash, status_code, response, expires_at)
+        VALUES (%s, %s, %s, %s::jsonb, CURRENT_TIMESTAMP + %s * interval '1 hour')
+        ON CONFLICT (key) DO UPDATE SET
+            request_hash = EXCLUDED.request_hash,
+            status_code = EXCLUDED.status_code,
+            response = EXCLUDED.response,
+            created_at = CURRENT_TIMESTAMP,
+            expires_at = EXCLUDED.expires_at
+    ''', (key, request_hash, status_code, dumps(payload).decode('utf-8'), TTL_HOURS))
+
+
+def purge_expired() -> None:
+    '''Удаляет пачку просроченных ключей, если с прошлой очистки прошло PURGE_INTERVAL'''
+    global _last_purge
+    now = time.monotonic()
+    if now - _last_purge < PURGE_INTERVAL:
+        return
+    _last_purge = now
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(PURGE_EXPIRED, (PURGE_BATCH_SIZE,))
+        conn.commit()
+        cursor.close()
@@ -1,296 +1,871 @@
+import base64
 import json
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from typing import Dict, Any
+import re
+from typing import Callable, Dict, Any, List, Optional, Tuple
 from datetime import datetime
-import urllib.request
-import urllib.parse
+from decimal import Decimal
+from html import escape
 
+import admission
+import db
+import idempotency
+import tracing
+from order_export import EXPORT_FORMATS, export_orders
+from order_report import parse_report_range, sales_report
+from responses import json_response, get_header, encoded_response, compress, negotiate_encoding
+
+OPTIONS_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, X-Read-After, Idempotency-Key',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': ''
+}
+
+METHOD_NOT_ALLOWED_RESPONSE = json_response(405, {'error': 'Method not allowed'})
+
+ITEM_ROW_TEMPLATE = '<tr><td>{name}</td><td>{size}</td><td>{quantity}</td><td>{price} ₽</td><td>{subtotal} ₽</td></tr>'
+
+ITEMS_TABLE_TEMPLATE = '''
+            <table style="border-collapse: collapse; width: 100%;">
+                <thead>
+                    <tr style="background-color: #f2f2f2;">
+                        <th style="border: 1px solid #ddd; padding: 8px;">Товар</th>
+                        <th style="border: 1px solid #ddd; padding: 8px;">Размер</th>
+                        <th style="border: 1px solid #ddd; padding: 8px;">Кол-во</th>
+                        <th style="border: 1px solid #ddd; padding: 8px;">Цена</th>
+                        <th style="border: 1px solid #ddd; padding: 8px;">Сумма</th>
+                    </tr>
+                </thead>
+                <tbody>{rows}</tbody>
+            </table>'''
+
+ADMIN_EMAIL_TEMPLATE = '''
+        <html>
+        <body style="font-family: Arial, sans-serif; color: #333;">
+            <h2 style="color: #4A90E2;">Новый заказ #{order_id}</h2>
+            <p><strong>Клиент:</strong> {customer_name}</p>
+            <p><strong>Телефон:</strong> {customer_phone}</p>
+            <p><strong>Email:</strong> {customer_email}</p>
+            <h3>Товары:</h3>{items_table}
+            <h3>Итого: {total_amount} ₽</h3>
+        </body>
+        </html>
+        '''
+
+CUSTOMER_EMAIL_TEMPLATE = '''
+        <html>
+        <body style="font-family: Arial, sans-serif; color: #333;">
+            <h2 style="color: #4A90E2;">Спасибо за заказ, {customer_name}!</h2>
+            <p>Ваш заказ <strong>#{order_id}</strong> успешно оформлен.</p>
+            <p>Мы свяжемся с вами в ближайшее время для подтверждения.</p>
+            <h3>Детали заказа:</h3>{items_table}
+            <h3>Итого: {total_amount} ₽</h3>
+            <hr style="margin: 20px 0; border: none; border-top: 1px solid #ddd;">
+            <p style="color: #777; font-size: 12px;">Это автоматическое письмо, отвечать на него не нужно.</p>
+        </body>
+        </html>
+        '''
+
+ORDER_COLUMNS = (
+    'id', 'customer_id', 'customer_name', 'customer_phone', 'customer_email',
+    'delivery_address', 'total_amount', 'status', 'payment_method',
+    'delivery_method', 'comment', 'created_at', 'updated_at'
+)
+
+ORDERS_WITH_ITEMS_QUERY = '''
+    SELECT {columns}, coalesce(oi.items, '[]'::json) AS items
+    FROM orders o
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_object(
+            'id', oi.id,
+            'product_name', oi.product_name,
+            'product_price', oi.product_price,
+            'size', oi.size,
+            'quantity', oi.quantity,
+            'subtotal', oi.subtotal
+        ) ORDER BY oi.id) AS items
+        FROM order_items oi
+        WHERE oi.order_id = o.id
+    ) oi ON true
+    WHERE o.id = ANY({ids})
+    ORDER BY o.id
+'''
+
+MAX_BATCH_IDS = 100
+
+db.register_statement('orders_by_ids', ORDERS_WITH_ITEMS_QUERY.format(columns='o.*', ids='$1::int[]'))
+
+CUSTOMER_UPSERT_CONFLICT = '''
+    ON CONFLICT (phone_normalized) DO UPDATE SET
+        name = EXCLUDED.name,
+        phone = EXCLUDED.phone,
+        email = coalesce(EXCLUDED.email, customers.email),
+        address = coalesce(EXCLUDED.address, customers.address),
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+db.register_statement('order_insert', '''
+    WITH customer AS (
+        INSERT INTO customers (name, phone, email, address, phone_normalized)
+        VALUES ($1, $2, $3, $4, $16)
+        ''' + CUSTOMER_UPSERT_CONFLICT + '''
+        RETURNING id
+    ), new_order AS (
+        INSERT INTO orders (
+            customer_id, customer_name, customer_phone, customer_email, 
+            delivery_address, payment_method, delivery_method,
+            comment, total_amount, status
+        )
+        SELECT customer.id, $1::varchar, $2::varchar, $3::varchar, $4::text,
+            $5::varchar, $6::varchar, $7::text, $8::numeric, $9::varchar
+        FROM customer
+        RETURNING id, customer_id
+    ), new_items AS (
+        INSERT INTO order_items (
+            order_id, product_id, product_name, 
+            product_price, size, quantity, subtotal
+        )
+        SELECT new_order.id, item.product_id, item.product_name,
+            item.product_price, item.size, item.quantity, item.subtotal
+        FROM new_order, unnest($10::int[], $11::text[], $12::numeric[], $13::text[], $14::int[], $15::numeric[])
+            AS item(product_id, product_name, product_price, size, quantity, subtotal)
+    )
+    SELECT id, customer_id FROM new_order
+''')
+
+db.register_statement('products_by_ids', '''
+    SELECT id, name, price FROM products WHERE id = ANY($1::int[])
+''')
+
+MAX_ITEM_QUANTITY = 100
+CENTS = Decimal('0.01')
+MAX_IMPORT_ORDERS = 1000
+ORDER_FIELDS = (
+    'customer_name', 'customer_phone', 'customer_email',
+    'delivery_address', 'payment_method', 'delivery_method', 'comment'
+)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 100
+
+ORDER_TRANSITIONS = {
+    'new': ('processing', 'shipped', 'cancelled'),
+    'processing': ('new', 'shipped', 'cancelled'),
+    'shipped': ('delivered', 'cancelled'),
+    'delivered': (),
+    'cancelled': ('new',)
+}
+MAX_STATUS_UPDATES = 500
+
+ALLOWED_TRANSITIONS_SQL = ', '.join(
+    f"('{current}', '{target}')"
+    for current, targets in ORDER_TRANSITIONS.items()
+    for target in targets
+)
+
+STATUS_UPDATE_QUERY = f'''
+    UPDATE orders o
+    SET status = c.status, updated_at = CURRENT_TIMESTAMP
+    FROM (VALUES %s) AS c(id, status, expected_updated_at)
+    WHERE o.id = c.id
+        AND (c.expected_updated_at IS NULL OR o.updated_at = c.expected_updated_at)
+        AND (o.status, c.status) IN ({ALLOWED_TRANSITIONS_SQL})
+    RETURNING o.id, o.status, o.updated_at
+'''
+
+def encode_cursor(values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+def cursor_timestamp(value: Any) -> datetime:
+    if not isinstance(value, str):
+        raise ValueError('cursor timestamp must be a string')
+    return datetime.fromisoformat(value)
+
+def decode_cursor(cursor: str, key: Callable[[Any], Any] = cursor_timestamp) -> List[Any]:
+    '''Ключ (значение сортировки, id) из курсора; значение разбирается функцией key, битый курсор - ValueError'''
+    padded = cursor + '=' * (-len(cursor) % 4)
+    values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('cursor must hold two values')
+    if isinstance(values[1], bool) or not isinstance(values[1], int):
+        raise ValueError('cursor id must be an integer')
+    return [key(values[0]), values[1]]
+
+def parse_limit(raw: Optional[str], default: int = DEFAULT_PAGE_SIZE) -> int:
+    if not raw:
+        return default
+    limit = int(raw)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, MAX_PAGE_SIZE)
+
+def parse_ids(raw: str) -> List[int]:
+    ids = [int(part) for part in raw.split(',') if part.strip()]
+    if not ids or len(ids) > MAX_BATCH_IDS:
+        raise ValueError(f'ids must list 1 to {MAX_BATCH_IDS} order ids')
+    return sorted(set(ids))
+
+def parse_fields(raw: Optional[str]) -> Tuple[Optional[List[str]], bool]:
+    '''
+    Проекция fields=id,status,total_amount,items: список колонок заказа и нужны ли позиции.
+    Без fields возвращаются все колонки и позиции.
+    '''
+    if not raw:
+        return None, True
+    fields = [field.strip() for field in raw.split(',') if field.strip()]
+    unknown = [field for field in fields if field != 'items' and field not in ORDER_COLUMNS]
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+    columns = [field for field in ORDER_COLUMNS if field in fields or field == 'id']
+    return columns, 'items' in fields
+
+def get_orders(cursor: Any, ids: List[int], columns: Optional[List[str]], with_items: bool) -> List[Dict[str, Any]]:
+    '''Заказы и их позиции по списку id одним запросом'''
+    if columns is None:
+        db.execute_prepared(cursor, 'orders_by_ids', (ids,))
+    else:
+        select = ', '.join(f'o.{column}' for column in columns)
+        if with_items:
+            cursor.execute(ORDERS_WITH_ITEMS_QUERY.format(columns=select, ids='%s'), (ids,))
+        else:
+            cursor.execute(f'SELECT {select} FROM orders o WHERE o.id = ANY(%s) ORDER BY o.id', (ids,))
+    return [dict(row) for row in cursor.fetchall()]
+
+def parse_export_range(params: Dict[str, str]) -> Tuple[Optional[datetime], Optional[datetime], Optional[List[Any]]]:
+    '''Диапазон выгрузки from/to (ISO-дата или дата-время, to не включается) и ключ продолжения cursor'''
+    start = datetime.fromisoformat(params['from']) if params.get('from') else None
+    end = datetime.fromisoformat(params['to']) if params.get('to') else None
+    after = decode_cursor(params['cursor']) if params.get('cursor') else None
+    return start, end, after
+
+def read_orders(ids: List[int], columns: Optional[List[str]], with_items: bool,
+                read_after: Optional[str]) -> List[Dict[str, Any]]:
+    '''
+    get_orders с реплики. Заказы, которых на реплике ещё нет (только что созданные,
+    а клиент не передал X-Read-After), дочитываются с primary.
+    '''
+    with db.connection(readonly=True, read_after=read_after) as conn:
+        cursor = conn.cursor()
+        orders = get_orders(cursor, ids, columns, with_items)
+        cursor.close()
+        replica = conn.replica
+    
+    missing = sorted(set(ids) - {order['id'] for order in orders})
+    if replica and missing:
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            orders = sorted(orders + get_orders(cursor, missing, columns, with_items), key=lambda order: order['id'])
+            cursor.close()
+    return orders
+
+def find_customer(cursor: Any, customer_id: Optional[int], phone: Optional[str]) -> Optional[Dict[str, Any]]:
+    '''Покупатель по id или телефону в любом формате (через уникальный индекс по нормализованному номеру)'''
+    if customer_id is not None:
+        cursor.execute('SELECT id, name, phone, email, address, created_at FROM customers WHERE id = %s', (customer_id,))
+    else:
+        cursor.execute('''
+            SELECT id, name, phone, email, address, created_at FROM customers WHERE phone_normalized = %s
+        ''', (normalize_phone(phone),))
+    row = cursor.fetchone()
+    return dict(row) if row else None
+
+def list_orders(cursor: Any, status: Optional[str], limit: int, after: Optional[str],
+                columns: Optional[List[str]] = None,
+                customer_id: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    '''Страница заказов по ключу (created_at, id), от новых к старым; для покупателя - по idx_orders_customer_created'''
+    select = '*'
+    if columns is not None:
+        select = ', '.join(sorted(set(columns) | {'created_at'}, key=ORDER_COLUMNS.index))
+    query = f'SELECT {select} FROM orders WHERE 1=1'
+    query_params: Dict[str, Any] = {'limit': limit + 1}
+    if customer_id is not None:
+        query += ' AND customer_id = %(customer_id)s'
+        query_params['customer_id'] = customer_id
+    if status:
+        query += ' AND status = %(status)s'
+        query_params['status'] = status
+    if after:
+        query_params['after_created_at'], query_params['after_id'] = decode_cursor(after)
+        query += ' AND (created_at, id) < (%(after_created_at)s::timestamp, %(after_id)s)'
+    query += ' ORDER BY created_at DESC, id DESC LIMIT %(limit)s'
+    
+    cursor.execute(query, query_params)
+    rows = [dict(row) for row in cursor.fetchall()]
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1]['created_at'].isoformat(), rows[-1]['id']])
+    if columns is not None and 'created_at' not in columns:
+        for row in rows:
+            del row['created_at']
+    return rows, next_cursor
+
+def load_products(cursor: Any, orders_items: List[List[Dict[str, Any]]]) -> Dict[int, Dict[str, Any]]:
+    '''Цены и названия всех товаров из корзин одним запросом'''
+    product_ids = set()
+    for items in orders_items:
+        for item in items:
+            if isinstance(item.get('product_id'), int):
+                product_ids.add(item['product_id'])
+    if not product_ids:
+        return {}
+    db.execute_prepared(cursor, 'products_by_ids', (sorted(product_ids),))
+    return {row['id']: row for row in cursor.fetchall()}
+
+def price_items(items: List[Dict[str, Any]], products: Dict[int, Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Decimal]:
+    '''
+    Пересчитывает позиции по ценам из каталога; цены и суммы от клиента игнорируются.
+    Цены приходят из базы float и переводятся в Decimal, чтобы суммы считались в копейках точно.
+    '''
+    priced = []
+    for item in items:
+        product = products.get(item.get('product_id'))
+        if product is None:
+            raise ValueError(f'Unknown product_id: {item.get("product_id")}')
+        quantity = item.get('quantity', 1)
+        if not isinstance(quantity, int) or not 1 <= quantity <= MAX_ITEM_QUANTITY:
+            raise ValueError(f'Invalid quantity for product_id {product["id"]}')
+        price = Decimal(str(product['price'])).quantize(CENTS)
+        priced.append({
+            'product_id': product['id'],
+            'product_name': product['name'],
+            'product_price': price,
+            'size': item.get('size'),
+            'quantity': quantity,
+            'subtotal': price * quantity
+        })
+    return priced, sum((item['subtotal'] for item in priced), Decimal('0'))
+
+def normalize_phone(phone: str) -> str:
+    '''Телефон для поиска покупателя, по тем же правилам, что normalize_phone() в базе'''
+    digits = re.sub(r'\D', '', phone or '')
+    if len(digits) == 11 and digits.startswith('8'):
+        return '7' + digits[1:]
+    if len(digits) == 10:
+        return '7' + digits
+    return digits
+
+def insert_order(cursor: Any, order_data: Dict[str, Any], priced_items: List[Dict[str, Any]],
+                 total_amount: Decimal) -> Tuple[int, int]:
+    '''Покупатель (upsert по телефону), заказ и все его позиции одним запросом; возвращает id заказа и покупателя'''
+    db.execute_prepared(cursor, 'order_insert', (
+        *(order_data.get(field) for field in ORDER_FIELDS), total_amount, 'new',
+        [item['product_id'] for item in priced_items],
+        [item['product_name'] for item in priced_items],
+        [item['product_price'] for item in priced_items],
+        [item['size'] for item in priced_items],
+        [item['quantity'] for item in priced_items],
+        [item['subtotal'] for item in priced_items],
+        normalize_phone(order_data['customer_phone'])
+    ))
+    row = cursor.fetchone()
+    return row['id'], row['customer_id']
+
+def upsert_customers(cursor: Any, orders_data: List[Dict[str, Any]]) -> Dict[str, int]:
+    '''Покупатели пачки заказов одним INSERT ... ON CONFLICT; id по нормализованному телефону'''
+    from psycopg2.extras import execute_values
+    
+    customers = {}
+    for order in orders_data:
+        customers[normalize_phone(order['customer_phone'])] = (
+            order['customer_name'], order['customer_phone'],
+            order.get('customer_email'), order.get('delivery_address')
+        )
+    rows = execute_values(cursor, '''
+        INSERT INTO customers (phone_normalized, name, phone, email, address) VALUES %s
+    ''' + CUSTOMER_UPSERT_CONFLICT + '''
+        RETURNING id, phone_normalized
+    ''', [(phone, *customer) for phone, customer in customers.items()], page_size=500, fetch=True)
+    return {row['phone_normalized']: row['id'] for row in rows}
+
+def import_orders(cursor: Any, orders_data: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    '''
+    Массовая загрузка заказов (синхронизация с маркетплейсами) за постоянное число запросов:
+    цены одним запросом, id заказов одним nextval, покупатели, заказы и позиции через execute_values.
+    Некорректные заказы пропускаются и возвращаются в rejected с индексом.
+    '''
+    from psycopg2.extras import execute_values
+    
+    products = load_products(cursor, [order.get('items') or [] for order in orders_data])
+    accepted = []
+    rejected = []
+    for index, order in enumerate(orders_data):
+        if not order.get('customer_name') or not order.get('customer_phone') or not order.get('items'):
+            rejected.append({'index': index, 'error': 'Missing required fields'})
+            continue
+        if not normalize_phone(order['customer_phone']):
+            rejected.append({'index': index, 'error': 'Invalid customer_phone'})
+            continue
+        try:
+            priced_items, total_amount = price_items(order['items'], products)
+        except ValueError as e:
+            rejected.append({'index': index, 'error': str(e)})
+            continue
+        accepted.append((index, order, priced_items, total_amount))
+    
+    if not accepted:
+        return [], rejected
+    
+    cursor.execute('''
+        SELECT nextval(pg_get_serial_sequence('orders', 'id')) AS id 
+        FROM generate_series(1, %s)
+    ''', (len(accepted),))
+    order_ids = [row['id'] for row in cursor.fetchall()]
+    customer_ids = upsert_customers(cursor, [order for _, order, _, _ in accepted])
+    
+    execute_values(cursor, '''
+        INSERT INTO orders (
+            id, customer_id, customer_name, customer_phone, customer_email, 
+            delivery_address, payment_method, delivery_method,
+            comment, total_amount, status
+        ) VALUES %s
+    ''', [
+        (order_id, customer_ids[normalize_phone(order['customer_phone'])],
+         *(order.get(field) for field in ORDER_FIELDS), total_amount, 'new')
+        for order_id, (_, order, _, total_amount) in zip(order_ids, accepted)
+    ], page_size=500)
+    
+    execute_values(cursor, '''
+        INSERT INTO order_items (
+            order_id, product_id, product_name, 
+            product_price, size, quantity, subtotal
+        ) VALUES %s
+    ''', [
+        (order_id, item['product_id'], item['product_name'], item['product_price'],
+         item['size'], item['quantity'], item['subtotal'])
+        for order_id, (_, _, priced_items, _) in zip(order_ids, accepted)
+        for item in priced_items
+    ], page_size=1000)
+    
+    imported = [{'index': index, 'order_id': order_id} for order_id, (index, _, _, _) in zip(order_ids, accepted)]
+    return imported, rejected
+
+def replay_response(replay: Tuple[int, Dict[str, Any]], position: Optional[str],
+                    event: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    '''Сохранённый ответ на повтор запроса с тем же Idempotency-Key'''
+    headers = db.read_after_headers(position)
+    headers[idempotency.REPLAY_HEADER] = 'true'
+    return json_response(*replay, event, headers)
+
+def parse_status_changes(entries: List[Any]) -> Tuple[List[Tuple[int, str, Optional[datetime]]], List[Dict[str, Any]]]:
+    '''
+    Проверяет записи {id, status, expected_updated_at} массовой смены статуса.
+    Некорректные записи и повторы id сразу попадают в результаты с result=invalid.
+    '''
+    changes = []
+    invalid = []
+    seen = set()
+    for entry in entries:
+        order_id = entry.get('id') if isinstance(entry, dict) else None
+        status = entry.get('status') if isinstance(entry, dict) else None
+        if not isinstance(order_id, int) or isinstance(order_id, bool):
+            invalid.append({'id': order_id, 'result': 'invalid', 'error': 'id must be an integer'})
+            continue
+        if status not in ORDER_TRANSITIONS:
+            invalid.append({'id': order_id, 'result': 'invalid', 'error': f'Unknown status: {status}'})
+            continue
+        if order_id in seen:
+            invalid.append({'id': order_id, 'result': 'invalid', 'error': 'Duplicate order id'})
+            continue
+        expected_updated_at = entry.get('expected_updated_at')
+        if expected_updated_at is not None:
+            try:
+                expected_updated_at = datetime.fromisoformat(expected_updated_at)
+            except (TypeError, ValueError):
+                invalid.append({'id': order_id, 'result': 'invalid', 'error': 'Invalid expected_updated_at'})
+                continue
+        seen.add(order_id)
+        changes.append((order_id, status, expected_updated_at))
+    return changes, invalid
+
+def apply_status_changes(cursor: Any, changes: List[Tuple[int, str, Optional[datetime]]]) -> List[Dict[str, Any]]:
+    '''
+    Применяет смены статуса одним UPDATE ... FROM (VALUES ...).
+    Строка обновляется, только если переход разрешён ORDER_TRANSITIONS и updated_at
+    совпадает с expected_updated_at (если он передан). Для необновлённых строк
+    причина определяется одним SELECT: not_found, conflict, unchanged или invalid_transition.
+    '''
+    from psycopg2.extras import execute_values
+    
+    updated = {
+        row['id']: row
+        for row in execute_values(cursor, STATUS_UPDATE_QUERY, changes,
+                                  template='(%s::int, %s::varchar, %s::timestamp)',
+                                  page_size=MAX_STATUS_UPDATES, fetch=True)
+    }
+    
+    skipped = [order_id for order_id, _, _ in changes if order_id not in updated]
+    current = {}
+    if skipped:
+        cursor.execute('SELECT id, status, updated_at FROM orders WHERE id = ANY(%s)', (skipped,))
+        current = {row['id']: row for row in cursor.fetchall()}
+    
+    results = []
+    for order_id, status, expected_updated_at in changes:
+        if order_id in updated:
+            row = updated[order_id]
+            results.append({'id': order_id, 'result': 'updated', 'status': row['status'], 'updated_at': row['updated_at']})
+            continue
+        row = current.get(order_id)
+        if row is None:
+            results.append({'id': order_id, 'result': 'not_found'})
+            continue
+        result = {'id': order_id, 'status': row['status'], 'updated_at': row['updated_at']}
+        if expected_updated_at is not None and row['updated_at'] != expected_updated_at:
+            result['result'] = 'conflict'
+        elif row['status'] == status:
+            result['result'] = 'unchanged'
+        else:
+            result['result'] = 'invalid_transition'
+            result['error'] = f'Cannot change status from {row["status"]} to {status}'
+        results.append(result)
+    return results
+
+@tracing.traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: API для создания и управления заказами
-    Args: event - dict с httpMethod, body (для POST), queryStringParameters (для GET)
+    Args: event - dict с httpMethod, body (для POST: заказ или {"orders": [...]} для импорта;
+                  для PUT: {id, status, expected_updated_at} или {"orders": [...]} для массовой смены статуса),
+                  queryStringParameters (для GET: id или ids=1,2,3, fields, status, limit, cursor;
+                  customer_id или customer_phone - история заказов покупателя;
+                  export=csv|ndjson с from, to, status и cursor для продолжения - выгрузка заказов;
+                  report=sales с from, to, statuses и top - отчёт о продажах по агрегатам)
           context - объект с атрибутами request_id, function_name
-    Returns: HTTP response с данными заказа или списком заказов
+    Returns: HTTP response с данными заказа или списком заказов; 429 с Retry-After при превышении лимита записей
     '''
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return OPTIONS_RESPONSE
     
-    database_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(database_url)
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    if method not in ('GET', 'POST', 'PUT'):
+        return METHOD_NOT_ALLOWED_RESPONSE
     
     if method == 'GET':
         params = event.get('queryStringParameters') or {}
         order_id = params.get('id')
+        order_ids = params.get('ids')
         status = params.get('status')
         
-        if order_id:
-            cursor.execute('''
-                SELECT o.*, 
-                    json_agg(json_build_object(
-                        'id', oi.id,
-                        'product_name', oi.product_name,
-                        'product_price', oi.product_price,
-                        'size', oi.size,
-                        'quantity', oi.quantity,
-                        'subtotal', oi.subtotal
-                    )) as items
-                FROM orders o
-                LEFT JOIN order_items oi ON o.id = oi.order_id
-                WHERE o.id = %s
-                GROUP BY o.id
-            ''' % order_id)
-            order = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
+        try:
+            columns, with_items = parse_fields(params.get('fields'))
+            ids = parse_ids(order_ids or order_id or '') if order_ids or order_id else None
+        except ValueError as e:
+            return json_response(400, {'error': str(e)})
+        
+        read_after = db.parse_read_after(get_header(event, db.READ_AFTER_HEADER))
+        
+        export_format = params.get('export')
+        if export_format:
+            if export_format not in EXPORT_FORMATS:
+                return json_response(400, {'error': f'export must be one of: {", ".join(EXPORT_FORMATS)}'})
+            try:
+                start, end, after = parse_export_range(params)
+            except (ValueError, TypeError):
+                return json_response(400, {'error': 'Invalid from, to or cursor'})
             
-            if not order:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'error': 'Order not found'})
-                }
+            with db.connection(readonly=True, read_after=read_after) as conn:
+                data, resume = export_orders(conn, export_format, start, end, status, after)
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps({'order': dict(order)}, ensure_ascii=False, default=str)
+            headers = {
+                'Content-Type': EXPORT_FORMATS[export_format],
+                'Content-Disposition': f'attachment; filename="orders.{export_format}"',
+                'Access-Control-Expose-Headers': 'X-Export-Next-Cursor'
             }
+            if resume is not None:
+                headers['X-Export-Next-Cursor'] = encode_cursor(resume)
+            encoding = negotiate_encoding(event, data)
+            if encoding is not None:
+                data = compress(data, encoding)
+            return encoded_response(200, data, encoding, headers)
         
-        query = 'SELECT * FROM orders WHERE 1=1'
-        if status:
-            query += f" AND status = '{status}'"
-        query += ' ORDER BY created_at DESC LIMIT 100'
+        report = params.get('report')
+        if report:
+            if report != 'sales':
+                return json_response(400, {'error': 'report must be: sales'})
+            try:
+                start, end, statuses, top = parse_report_range(params, list(ORDER_TRANSITIONS))
+            except (ValueError, TypeError) as e:
+                return json_response(400, {'error': f'Invalid report parameters: {e}'})
+            
+            with db.connection(readonly=True, read_after=read_after) as conn:
+                cursor = conn.cursor()
+                with tracing.phase('report'):
+                    payload = sales_report(cursor, start, end, statuses, top)
+                cursor.close()
+            
+            return json_response(200, payload, event)
         
-        cursor.execute(query)
-        orders = cursor.fetchall()
+        if params.get('customer_id') or params.get('customer_phone'):
+            after = params.get('cursor')
+            try:
+                customer_id = int(params['customer_id']) if params.get('customer_id') else None
+                limit = parse_limit(params.get('limit'))
+                if after:
+                    decode_cursor(after)
+            except (ValueError, TypeError):
+                return json_response(400, {'error': 'Invalid customer_id, limit or cursor'})
+            
+            with db.connection(readonly=True, read_after=read_after) as conn:
+                cursor = conn.cursor()
+                customer = find_customer(cursor, customer_id, params.get('customer_phone'))
+                if customer:
+                    orders, next_cursor = list_orders(cursor, status, limit, after, columns, customer['id'])
+                cursor.close()
+            
+            if not customer:
+                return json_response(404, {'error': 'Customer not found'})
+            
+            return json_response(200, {'customer': customer, 'orders': orders, 'next_cursor': next_cursor}, event)
         
-        cursor.close()
-        conn.close()
+        if order_ids:
+            orders = read_orders(ids, columns, with_items, read_after)
+            
+            found = {order['id'] for order in orders}
+            return json_response(200, {
+                'orders': orders,
+                'missing': [i for i in ids if i not in found]
+            }, event)
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({'orders': [dict(row) for row in orders]}, ensure_ascii=False, default=str)
-        }
+        if order_id:
+            orders = read_orders(ids, columns, with_items, read_after)
+            order = orders[0] if orders else None
+            
+            if not order:
+                return json_response(404, {'error': 'Order not found'})
+            
+            return json_response(200, {'order': order}, event)
+        
+        after = params.get('cursor')
+        try:
+            limit = parse_limit(params.get('limit'))
+            if after:
+                decode_cursor(after)
+        except (ValueError, TypeError):
+            return json_response(400, {'error': 'Invalid limit or cursor'})
+        
+        with db.connection(readonly=True, read_after=read_after) as conn:
+            cursor = conn.cursor()
+            orders, next_cursor = list_orders(cursor, status, limit, after, columns)
+            cursor.close()
+        
+        return json_response(200, {'orders': orders, 'next_cursor': next_cursor}, event)
     
     if method == 'POST':
         body_data = json.loads(event.get('body', '{}'))
         
+        throttled = admission.admit(event)
+        if throttled is not None:
+            return throttled
+        
+        try:
+            idempotency_key = idempotency.parse_key(get_header(event, idempotency.KEY_HEADER))
+        except ValueError as e:
+            return json_response(400, {'error': str(e)})
+        request_hash = idempotency.fingerprint(body_data) if idempotency_key else None
+        
+        if 'orders' in body_data:
+            orders_data = body_data.get('orders')
+            if not isinstance(orders_data, list) or not orders_data or len(orders_data) > MAX_IMPORT_ORDERS:
+                return json_response(400, {'error': f'orders must be a non-empty list of at most {MAX_IMPORT_ORDERS} orders'})
+            
+            with db.connection() as conn:
+                cursor = conn.cursor()
+                replay = None
+                if idempotency_key:
+                    try:
+                        replay = idempotency.acquire(cursor, idempotency_key, request_hash)
+                    except ValueError as e:
+                        cursor.close()
+                        return json_response(422, {'error': str(e)})
+                if replay is None:
+                    imported, rejected = import_orders(cursor, orders_data)
+                    status_code, payload = 201 if imported else 400, {'imported': imported, 'rejected': rejected}
+                    if idempotency_key and imported:
+                        idempotency.remember(cursor, idempotency_key, request_hash, status_code, payload)
+                else:
+                    status_code, payload = replay
+                conn.commit()
+                position = db.write_position(cursor)
+                cursor.close()
+            
+            if replay is not None:
+                return replay_response(replay, position, event)
+            if idempotency_key:
+                idempotency.purge_expired()
+            return json_response(status_code, payload, event, db.read_after_headers(position))
+        
         customer_name = body_data.get('customer_name')
         customer_phone = body_data.get('customer_phone')
         customer_email = body_data.get('customer_email')
-        delivery_address = body_data.get('delivery_address')
-        payment_method = body_data.get('payment_method')
-        delivery_method = body_data.get('delivery_method')
-        comment = body_data.get('comment')
         items = body_data.get('items', [])
         
         if not customer_name or not customer_phone or not items:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps({'error': 'Missing required fields'})
-            }
+            return json_response(400, {'error': 'Missing required fields'})
         
-        total_amount = sum(item.get('subtotal', 0) for item in items)
+        if not normalize_phone(customer_phone):
+            return json_response(400, {'error': 'Invalid customer_phone'})
         
-        cursor.execute('''
-            INSERT INTO orders (
-                customer_name, customer_phone, customer_email, 
-                delivery_address, payment_method, delivery_method,
-                comment, total_amount, status
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        ''', (
-            customer_name, customer_phone, customer_email,
-            delivery_address, payment_method, delivery_method,
-            comment, total_amount, 'new'
-        ))
+        if idempotency_key:
+            with db.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    replay = idempotency.lookup(cursor, idempotency_key, request_hash)
+                except ValueError as e:
+                    cursor.close()
+                    return json_response(422, {'error': str(e)})
+                position = db.write_position(cursor) if replay is not None else None
+                cursor.close()
+            if replay is not None:
+                return replay_response(replay, position)
         
-        order_id = cursor.fetchone()['id']
+        throttled = admission.admit(None, normalize_phone(customer_phone))
+        if throttled is not None:
+            return throttled
         
-        for item in items:
-            cursor.execute('''
-                INSERT INTO order_items (
-                    order_id, product_id, product_name, 
-                    product_price, size, quantity, subtotal
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                order_id, item.get('product_id'), item.get('product_name'),
-                item.get('product_price'), item.get('size'), 
-                item.get('quantity', 1), item.get('subtotal')
-            ))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            
+            if idempotency_key:
+                try:
+                    replay = idempotency.acquire(cursor, idempotency_key, request_hash)
+                except ValueError as e:
+                    cursor.close()
+                    return json_response(422, {'error': str(e)})
+                if replay is not None:
+                    conn.commit()
+                    position = db.write_position(cursor)
+                    cursor.close()
+                    return replay_response(replay, position)
+            
+            try:
+                priced_items, total_amount = price_items(items, load_products(cursor, [items]))
+            except ValueError as e:
+                cursor.close()
+                return json_response(400, {'error': str(e)})
+            
+            order_id, customer_id = insert_order(cursor, body_data, priced_items, total_amount)
+            
+            queue_order_emails(cursor, order_id, customer_name, customer_email, customer_phone, total_amount, priced_items)
+            
+            payload = {
+                'order_id': order_id,
+                'customer_id': customer_id,
+                'total_amount': total_amount,
+                'message': 'Order created successfully'
+            }
+            if idempotency_key:
+                idempotency.remember(cursor, idempotency_key, request_hash, 201, payload)
+            
+            conn.commit()
+            position = db.write_position(cursor)
+            cursor.close()
         
-        send_order_emails(order_id, customer_name, customer_email, customer_phone, total_amount, items)
+        if idempotency_key:
+            idempotency.purge_expired()
         
-        return {
-            'statusCode': 201,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({'order_id': order_id, 'message': 'Order created successfully'})
-        }
+        return json_response(201, payload, headers=db.read_after_headers(position))
     
     if method == 'PUT':
         body_data = json.loads(event.get('body', '{}'))
-        order_id = body_data.get('id')
-        status = body_data.get('status')
         
-        if not order_id or not status:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps({'error': 'Missing order id or status'})
-            }
+        throttled = admission.admit(event)
+        if throttled is not None:
+            return throttled
         
-        cursor.execute('''
-            UPDATE orders 
-            SET status = %s, updated_at = CURRENT_TIMESTAMP 
-            WHERE id = %s
-        ''', (status, order_id))
+        if 'orders' in body_data:
+            entries = body_data.get('orders')
+            if not isinstance(entries, list) or not entries or len(entries) > MAX_STATUS_UPDATES:
+                return json_response(400, {'error': f'orders must be a non-empty list of at most {MAX_STATUS_UPDATES} entries'})
+            
+            changes, results = parse_status_changes(entries)
+            if changes:
+                with db.connection() as conn:
+                    cursor = conn.cursor()
+                    results = apply_status_changes(cursor, changes) + results
+                    conn.commit()
+                    position = db.write_position(cursor)
+                    cursor.close()
+            else:
+                position = None
+            
+            counts: Dict[str, int] = {}
+            for result in results:
+                counts[result['result']] = counts.get(result['result'], 0) + 1
+            return json_response(200, {'results': results, 'counts': counts}, event, db.read_after_headers(position))
         
-        conn.commit()
-        cursor.close()
-        conn.close()
+        if not body_data.get('id') or not body_data.get('status'):
+            return json_response(400, {'error': 'Missing order id or status'})
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({'message': 'Order updated successfully'})
-        }
-    
-    cursor.close()
-    conn.close()
-    
-    return {
-        'statusCode': 405,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'isBase64Encoded': False,
-        'body': json.dumps({'error': 'Method not allowed'})
-    }
+        changes, invalid = parse_status_changes([body_data])
+        if invalid:
+            return json_response(400, {'error': invalid[0]['error']})
+        
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            result = apply_status_changes(cursor, changes)[0]
+            conn.commit()
+            position = db.write_position(cursor)
+            cursor.close()
+        
+        if result['result'] == 'not_found':
+            return json_response(404, {'error': 'Order not found'})
+        if result['result'] == 'conflict':
+            return json_response(409, {'error': 'Order was modified concurrently', 'order': result})
+        if result['result'] == 'invalid_transition':
+            return json_response(409, {'error': result['error'], 'order': result})
+        
+        return json_response(200, {'message': 'Order updated successfully', 'order': result},
+                             headers=db.read_after_headers(position))
 
-def send_order_emails(order_id: int, customer_name: str, customer_email: str, customer_phone: str, total_amount: float, items: list):
+def queue_order_emails(cursor: Any, order_id: int, customer_name: str, customer_email: str, customer_phone: str, total_amount: float, items: list):
+    '''
+    Кладёт письма о заказе в email_outbox в той же транзакции, что и сам заказ.
+    Отправкой занимается функция email-dispatcher.
+    '''
     admin_email = os.environ.get('ADMIN_EMAIL')
-    email_function_url = 'https://functions.poehali.dev/send-email'
+    messages = []
     
-    items_html = ''.join([
-        f'<tr><td>{item.get("product_name")}</td><td>{item.get("size", "-")}</td><td>{item.get("quantity")}</td><td>{item.get("product_price")} ₽</td><td>{item.get("subtotal")} ₽</td></tr>'
+    items_table = ITEMS_TABLE_TEMPLATE.format(rows=''.join([
+        ITEM_ROW_TEMPLATE.format(
+            name=escape(str(item.get('product_name'))),
+            size=escape(str(item.get('size') or '-')),
+            quantity=item.get('quantity'),
+            price=item.get('product_price'),
+            subtotal=item.get('subtotal')
+        )
         for item in items
-    ])
+    ]))
     
     if admin_email:
-        admin_html = f'''
-        <html>
-        <body style="font-family: Arial, sans-serif; color: #333;">
-            <h2 style="color: #4A90E2;">Новый заказ #{order_id}</h2>
-            <p><strong>Клиент:</strong> {customer_name}</p>
-            <p><strong>Телефон:</strong> {customer_phone}</p>
-            <p><strong>Email:</strong> {customer_email or "не указан"}</p>
-            <h3>Товары:</h3>
-            <table style="border-collapse: collapse; width: 100%;">
-                <thead>
-                    <tr style="background-color: #f2f2f2;">
-                        <th style="border: 1px solid #ddd; padding: 8px;">Товар</th>
-                        <th style="border: 1px solid #ddd; padding: 8px;">Размер</th>
-                        <th style="border: 1px solid #ddd; padding: 8px;">Кол-во</th>
-                        <th style="border: 1px solid #ddd; padding: 8px;">Цена</th>
-                        <th style="border: 1px solid #ddd; padding: 8px;">Сумма</th>
-                    </tr>
-                </thead>
-                <tbody>{items_html}</tbody>
-            </table>
-            <h3>Итого: {total_amount} ₽</h3>
-        </body>
-        </html>
-        '''
-        
-        admin_data = json.dumps({
-            'to': admin_email,
-            'subject': f'Новый заказ #{order_id} на сайте VIVASS',
-            'html': admin_html
-        }).encode('utf-8')
-        
-        admin_req = urllib.request.Request(
-            email_function_url,
-            data=admin_data,
-            headers={'Content-Type': 'application/json'},
-            method='POST'
+        admin_html = ADMIN_EMAIL_TEMPLATE.format(
+            order_id=order_id,
+            customer_name=escape(customer_name),
+            customer_phone=escape(customer_phone),
+            customer_email=escape(customer_email or 'не указан'),
+            items_table=items_table,
+            total_amount=total_amount
         )
-        
-        try:
-            urllib.request.urlopen(admin_req)
-        except Exception:
-            pass
+        messages.append((order_id, admin_email, f'Новый заказ #{order_id} на сайте VIVASS', admin_html))
     
     if customer_email:
-        customer_html = f'''
-        <html>
-        <body style="font-family: Arial, sans-serif; color: #333;">
-            <h2 style="color: #4A90E2;">Спасибо за заказ, {customer_name}!</h2>
-            <p>Ваш заказ <strong>#{order_id}</strong> успешно оформлен.</p>
-            <p>Мы свяжемся с вами в ближайшее время для подтверждения.</p>
-            <h3>Детали заказа:</h3>
-            <table style="border-collapse: collapse; width: 100%;">
-                <thead>
-                    <tr style="background-color: #f2f2f2;">
-                        <th style="border: 1px solid #ddd; padding: 8px;">Товар</th>
-                        <th style="border: 1px solid #ddd; padding: 8px;">Размер</th>
-                        <th style="border: 1px solid #ddd; padding: 8px;">Кол-во</th>
-                        <th style="border: 1px solid #ddd; padding: 8px;">Цена</th>
-                        <th style="border: 1px solid #ddd; padding: 8px;">Сумма</th>
-                    </tr>
-                </thead>
-                <tbody>{items_html}</tbody>
-            </table>
-            <h3>Итого: {total_amount} ₽</h3>
-            <hr style="margin: 20px 0; border: none; border-top: 1px solid #ddd;">
-            <p style="color: #777; font-size: 12px;">Это автоматическое письмо, отвечать на него не нужно.</p>
-        </body>
-        </html>
-        '''
-        
-        customer_data = json.dumps({
-            'to': customer_email,
-            'subject': f'Ваш заказ #{order_id} в магазине VIVASS',
-            'html': customer_html
-        }).encode('utf-8')
-        
-        customer_req = urllib.request.Request(
-            email_function_url,
-            data=customer_data,
-            headers={'Content-Type': 'application/json'},
-            method='POST'
+        customer_html = CUSTOMER_EMAIL_TEMPLATE.format(
+            order_id=order_id,
+            customer_name=escape(customer_name),
+            items_table=items_table,
+            total_amount=total_amount
         )
-        
-        try:
-            urllib.request.urlopen(customer_req)
-        except Exception:
-            pass
\ No newline at end of file
+        messages.append((order_id, customer_email, f'Ваш заказ #{order_id} в магазине VIVASS', customer_html))
+    
+    if messages:
+        from psycopg2.extras import execute_values
+        execute_values(cursor, '''
+            INSERT INTO email_outbox (order_id, to_email, subject, html) VALUES %s
+        ''', messages)
@@ -0,0 +1,156 @@
+'''
+Выгрузка заказов с позициями для бухгалтерии в CSV или NDJSON.
+Строки читаются именованным (серверным) курсором порциями по EXPORT_CHUNK_SIZE
+в порядке (created_at, id) по индексу idx_orders_created_id, так что память
+не зависит от размера диапазона. Тело одного ответа ограничено EXPORT_MAX_BYTES байт UTF-8;
+если диапазон не поместился, возвращается курсор для продолжения с последнего
+выгруженного (created_at, id). В CSV суммы заказа и позиций идут как есть из NUMERIC
+("2990.00"), а не float, как в остальных ответах: позиции из json_agg разбираются с parse_float=Decimal.
+'''
+import csv
+import io
+import json
+import os
+from datetime import date, datetime
+from decimal import Decimal
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+import tracing
+from responses import encode_json
+
+EXPORT_CHUNK_SIZE = int(os.environ.get('ORDER_EXPORT_CHUNK_SIZE', '2000'))
+EXPORT_MAX_BYTES = int(os.environ.get('ORDER_EXPORT_MAX_BYTES', str(4 * 1024 * 1024)))
+
+EXPORT_ORDER_COLUMNS = (
+    'id', 'customer_id', 'customer_name', 'customer_phone', 'customer_email',
+    'delivery_address', 'total_amount', 'status', 'payment_method',
+    'delivery_method', 'comment', 'created_at', 'updated_at'
+)
+EXPORT_ITEM_COLUMNS = ('id', 'product_id', 'product_name', 'product_price', 'size', 'quantity', 'subtotal')
+
+JSON_OID = 114
+JSON_ARRAY_OID = 199
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson'
+}
+
+EXPORT_QUERY = '''
+    SELECT {columns}, coalesce(oi.items, '[]'::json) AS items
+    FROM orders o
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_object(
+            'id', oi.id,
+            'product_id', oi.product_id,
+            'product_name', oi.product_name,
+            'product_price', oi.product_price,
+            'size', oi.size,
+            'quantity', oi.quantity,
+            'subtotal', oi.subtotal
+        ) ORDER BY oi.id) AS items
+        FROM order_items oi
+        WHERE oi.order_id = o.id
+    ) oi ON true
+    WHERE {filters}
+    ORDER BY o.created_at, o.id
+'''
+
+
+def _csv_value(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+class CsvWriter:
+    '''Одна строка CSV на позицию заказа; заказ без позиций даёт одну строку с пустыми полями позиции'''
+
+    def __init__(self, out: io.BytesIO) -> None:
+        self._out = out
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        self._writer.writerow(EXPORT_ORDER_COLUMNS + tuple(f'item_{column}' for column in EXPORT_ITEM_COLUMNS))
+        self._flush()
+
+    def _flush(self) -> None:
+        self._out.write(self._buffer.getvalue().encode('utf-8'))
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+    def write(self, order: Tuple[Any, ...], items: List[Dict[str, Any]]) -> None:
+        order_values = [_csv_value(value) for value in order]
+        if not items:
+            self._writer.writerow(order_values)
+        for item in items:
+            self._writer.writerow(order_values + [item.get(column) for column in EXPORT_ITEM_COLUMNS])
+        self._flush()
+
+
+class NdjsonWriter:
+    '''Один JSON-объект заказа с массивом items на строку'''
+
+    def __init__(self, out: io.BytesIO) -> None:
+        self._out = out
+
+    def write(self, order: Tuple[Any, ...], items: List[Dict[str, Any]]) -> None:
+        record = dict(zip(EXPORT_ORDER_COLUMNS, order))
+        record['items'] = items
+        self._out.write(encode_json(record))
+        self._out.write(b'\n')
+
+
+def export_orders(conn: Any, fmt: str, start: Optional[datetime], end: Optional[datetime],
+                  status: Optional[str], after: Optional[List[Any]]) -> Tuple[bytes, Optional[List[Any]]]:
+    '''
+    Выгружает заказы с created_at в [start, end) после ключа after.
+    Возвращает тело и ключ (created_at, id) последнего заказа, если выгрузка упёрлась в EXPORT_MAX_BYTES.
+    '''
+    import psycopg2.extensions
+    import psycopg2.extras
+
+    filters = ['true']
+    query_params: Dict[str, Any] = {}
+    if start is not None:
+        filters.append('o.created_at >= %(start)s')
+        query_params['start'] = start
+    if end is not None:
+        filters.append('o.created_at < %(end)s')
+        query_params['end'] = end
+    if status:
+        filters.append('o.status = %(status)s')
+        query_params['status'] = status
+    if after:
+        filters.append('(o.created_at, o.id) > (%(after_created_at)s::timestamp, %(after_id)s)')
+        query_params['after_created_at'], query_params['after_id'] = after
+
+    out = io.BytesIO()
+    writer = CsvWriter(out) if fmt == 'csv' else NdjsonWriter(out)
+    created_at_index = EXPORT_ORDER_COLUMNS.index('created_at')
+    resume = None
+
+    cursor = conn.cursor(name='orders_export', cursor_factory=psycopg2.extensions.cursor)
+    if fmt == 'csv':
+        psycopg2.extensions.register_type(psycopg2.extensions.DECIMAL, cursor)
+        psycopg2.extras.register_json(cursor, loads=partial(json.loads, parse_float=Decimal),
+                                      oid=JSON_OID, array_oid=JSON_ARRAY_OID)
+    cursor.itersize = EXPORT_CHUNK_SIZE
+    try:
+        cursor.execute(EXPORT_QUERY.format(
+            columns=', '.join(f'o.{column}' for column in EXPORT_ORDER_COLUMNS),
+            filters=' AND '.join(filters)
+        ), query_params)
+        with tracing.phase('export'):
+            while resume is None:
+                rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    writer.write(row[:-1], row[-1])
+                    if out.tell() >= EXPORT_MAX_BYTES:
+                        resume = [row[created_at_index].isoformat(), row[0]]
+                        break
+    finally:
+        cursor.close()
+    return out.getvalue(), resume
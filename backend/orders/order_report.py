@@ -0,0 +1,117 @@
+'''
+Отчёт о продажах за диапазон дней из дневных агрегатов order_stats и order_product_stats
+(миграция V0009). Агрегаты поддерживаются триггерами при создании заказов и смене статуса,
+поэтому отчёт читает не больше строк, чем дней x статусов x категорий, независимо от числа заказов.
+'''
+import os
+from datetime import date, timedelta
+from typing import Any, Dict, List, Tuple
+
+REPORT_DEFAULT_DAYS = int(os.environ.get('ORDER_REPORT_DEFAULT_DAYS', '30'))
+REPORT_MAX_DAYS = int(os.environ.get('ORDER_REPORT_MAX_DAYS', '1100'))
+REPORT_DEFAULT_TOP = 10
+REPORT_MAX_TOP = 100
+REPORT_EXCLUDED_STATUSES = ('cancelled',)
+
+UNCATEGORIZED = -1
+
+REPORT_TOTALS = '''
+    SELECT coalesce(sum(orders), 0) AS orders, coalesce(sum(units), 0) AS units,
+        coalesce(sum(revenue), 0) AS revenue
+    FROM order_stats
+    WHERE category_id = 0 AND day >= %(start)s AND day < %(end)s AND status = ANY(%(statuses)s)
+'''
+
+REPORT_BY_DAY = '''
+    SELECT day, sum(orders) AS orders, sum(units) AS units, sum(revenue) AS revenue
+    FROM order_stats
+    WHERE category_id = 0 AND day >= %(start)s AND day < %(end)s AND status = ANY(%(statuses)s)
+    GROUP BY day
+    ORDER BY day
+'''
+
+REPORT_BY_STATUS = '''
+    SELECT status, sum(orders) AS orders, sum(units) AS units, sum(revenue) AS revenue
+    FROM order_stats
+    WHERE category_id = 0 AND day >= %(start)s AND day < %(end)s AND status = ANY(%(statuses)s)
+    GROUP BY status
+    ORDER BY status
+'''
+
+REPORT_BY_CATEGORY = '''
+    SELECT s.category_id, c.name AS category, s.orders, s.units, s.revenue
+    FROM (
+        SELECT category_id, sum(orders) AS orders, sum(units) AS units, sum(revenue) AS revenue
+        FROM order_stats
+        WHERE category_id <> 0 AND day >= %(start)s AND day < %(end)s AND status = ANY(%(statuses)s)
+        GROUP BY category_id
+    ) s
+    LEFT JOIN categories c ON c.id = s.category_id
+    ORDER BY s.revenue DESC, s.category_id
+'''
+
+REPORT_TOP_PRODUCTS = '''
+    SELECT s.product_id, p.name AS product_name, s.units, s.revenue
+    FROM (
+        SELECT product_id, sum(units) AS units, sum(revenue) AS revenue
+        FROM order_product_stats
+        WHERE day >= %(start)s AND day < %(end)s AND status = ANY(%(statuses)s)
+        GROUP BY product_id
+        HAVING sum(units) > 0
+        ORDER BY sum(revenue) DESC, product_id
+        LIMIT %(top)s
+    ) s
+    LEFT JOIN products p ON p.id = s.product_id
+    ORDER BY s.revenue DESC, s.product_id
+'''
+
+
+def parse_report_range(params: Dict[str, str], known_statuses: List[str]) -> Tuple[date, date, List[str], int]:
+    '''
+    Диапазон отчёта from/to (ISO-даты, to не включается; по умолчанию последние REPORT_DEFAULT_DAYS дней),
+    statuses=new,shipped (по умолчанию все, кроме отменённых) и top - число товаров в рейтинге.
+    '''
+    end = date.fromisoformat(params['to']) if params.get('to') else date.today() + timedelta(days=1)
+    start = date.fromisoformat(params['from']) if params.get('from') else end - timedelta(days=REPORT_DEFAULT_DAYS)
+    if start >= end:
+        raise ValueError('from must be before to')
+    if (end - start).days > REPORT_MAX_DAYS:
+        raise ValueError(f'Report range must not exceed {REPORT_MAX_DAYS} days')
+
+    if params.get('statuses'):
+        statuses = [status.strip() for status in params['statuses'].split(',') if status.strip()]
+        unknown = [status for status in statuses if status not in known_statuses]
+        if unknown:
+            raise ValueError(f'Unknown statuses: {", ".join(unknown)}')
+    else:
+        statuses = [status for status in known_statuses if status not in REPORT_EXCLUDED_STATUSES]
+
+    top = int(params['top']) if params.get('top') else REPORT_DEFAULT_TOP
+    if top < 1:
+        raise ValueError('top must be positive')
+    return start, end, statuses, min(top, REPORT_MAX_TOP)
+
+
+def _rows(cursor: Any, query: str, query_params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    cursor.execute(query, query_params)
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def sales_report(cursor: Any, start: date, end: date, statuses: List[str], top: int) -> Dict[str, Any]:
+    '''Выручка, число заказов и проданных единиц: итог, по дням, статусам, категориям и топ товаров'''
+    query_params = {'start': start, 'end': end, 'statuses': statuses, 'top': top}
+    totals = _rows(cursor, REPORT_TOTALS, query_params)[0]
+    by_category = _rows(cursor, REPORT_BY_CATEGORY, query_params)
+    for row in by_category:
+        if row['category_id'] == UNCATEGORIZED:
+            row['category_id'] = None
+    return {
+        'from': start,
+        'to': end,
+        'statuses': statuses,
+        'totals': totals,
+        'by_day': _rows(cursor, REPORT_BY_DAY, query_params),
+        'by_status': _rows(cursor, REPORT_BY_STATUS, query_params),
+        'by_category': by_category,
+        'top_products': _rows(cursor, REPORT_TOP_PRODUCTS, query_params)
+    }
@@ -0,0 +1,127 @@
+'''
+Общий слой HTTP-ответов: сериализация JSON и сжатие тела.
+orjson используется, если установлен (datetime он сериализует сам, без callback),
+иначе стандартный json. NUMERIC из базы уже float (см. db.py), так что _default
+вызывается только для Decimal, посчитанных в коде. Тела от RESPONSE_COMPRESS_MIN_BYTES сжимаются brotli или gzip,
+если клиент прислал подходящий Accept-Encoding.
+'''
+import base64
+import gzip
+import json
+import os
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, Optional
+
+import tracing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.environ.get('RESPONSE_GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('RESPONSE_BROTLI_QUALITY', '5'))
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def encode_json(payload: Any) -> bytes:
+    '''JSON в UTF-8 без замера фазы - для построчной сериализации внутри другой фазы'''
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default)
+    return json.dumps(payload, ensure_ascii=False, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def dumps(payload: Any) -> bytes:
+    with tracing.phase('serialize'):
+        return encode_json(payload)
+
+
+def get_header(event: Optional[Dict[str, Any]], name: str) -> str:
+    headers = (event or {}).get('headers') or {}
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+
+def accepted_encoding(event: Optional[Dict[str, Any]]) -> Optional[str]:
+    '''Лучшее поддерживаемое сжатие из Accept-Encoding: br, затем gzip'''
+    accepted = set()
+    for part in get_header(event, 'Accept-Encoding').lower().split(','):
+        coding, _, params = part.strip().partition(';')
+        key, _, value = params.partition('=')
+        if key.strip() == 'q':
+            try:
+                if float(value) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip())
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    with tracing.phase('compress'):
+        if encoding == 'br':
+            return brotli.compress(data, quality=BROTLI_QUALITY)
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def encoded_response(status_code: int, data: bytes, encoding: Optional[str],
+                     headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    '''Ответ из уже сериализованного (и, возможно, уже сжатого) тела'''
+    response_headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    response_headers.update(headers or {})
+    if encoding is None:
+        return {
+            'statusCode': status_code,
+            'headers': response_headers,
+            'isBase64Encoded': False,
+            'body': data.decode('utf-8')
+        }
+    response_headers['Content-Encoding'] = encoding
+    response_headers['Vary'] = 'Accept-Encoding'
+    return {
+        'statusCode': status_code,
+        'headers': response_headers,
+        'isBase64Encoded': True,
+        'body': base64.b64encode(data).decode('ascii')
+    }
+
+
+def negotiate_encoding(event: Optional[Dict[str, Any]], data: bytes) -> Optional[str]:
+    if event is None or len(data) < COMPRESS_MIN_BYTES:
+        return None
+    return accepted_encoding(event)
+
+
+def json_response(status_code: int, payload: Any, event: Optional[Dict[str, Any]] = None,
+                  headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    '''
+    JSON-ответ функции. Если передан event, тело сжимается согласно Accept-Encoding
+    и отдаётся в base64 с isBase64Encoded: True.
+    '''
+    data = dumps(payload)
+    encoding = negotiate_encoding(event, data)
+    if encoding is not None:
+        data = compress(data, encoding)
+    return encoded_response(status_code, data, encoding, headers)
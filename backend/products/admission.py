@@ -0,0 +1,193 @@
+'''
+Допуск запросов на запись: token bucket по IP клиента и телефону и сброс нагрузки.
+Вёдра общие для всех тёплых экземпляров и хранятся в rate_limits (функция take_rate_limit_token),
+а каждый экземпляр держит их локальную копию: пустое локальное ведро отклоняет запрос
+без соединения с базой, так что флуд с одного адреса не доходит до Postgres.
+Если активных запросов в базе больше ADMISSION_MAX_IN_FLIGHT (проверка не чаще
+ADMISSION_LOAD_CHECK_INTERVAL) или пул соединений исчерпан, записи ADMISSION_SHED_SECONDS
+отклоняются сразу. Отказ - 429 с Retry-After.
+'''
+import hashlib
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import db
+from responses import get_header, json_response
+
+IP_RATE = float(os.environ.get('RATE_LIMIT_IP_RATE', '1'))
+IP_BURST = float(os.environ.get('RATE_LIMIT_IP_BURST', '20'))
+PHONE_RATE = float(os.environ.get('RATE_LIMIT_PHONE_RATE', '0.05'))
+PHONE_BURST = float(os.environ.get('RATE_LIMIT_PHONE_BURST', '5'))
+MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', '50'))
+LOAD_CHECK_INTERVAL = float(os.environ.get('ADMISSION_LOAD_CHECK_INTERVAL', '1'))
+SHED_SECONDS = float(os.environ.get('ADMISSION_SHED_SECONDS', '5'))
+PURGE_INTERVAL = float(os.environ.get('RATE_LIMIT_PURGE_INTERVAL', '300'))
+PURGE_IDLE_SECONDS = float(os.environ.get('RATE_LIMIT_PURGE_IDLE_SECONDS', '3600'))
+PURGE_BATCH_SIZE = int(os.environ.get('RATE_LIMIT_PURGE_BATCH_SIZE', '5000'))
+MAX_LOCAL_BUCKETS = 10000
+
+IN_FLIGHT_QUERY = '''
+    SELECT count(*) AS in_flight
+    FROM pg_stat_activity
+    WHERE datname = current_database() AND state = 'active' AND backend_type = 'client backend'
+'''
+
+TAKE_TOKENS = '''
+    SELECT b.key, t.allowed, t.remaining
+    FROM unnest(%s::varchar[], %s::float8[], %s::float8[]) WITH ORDINALITY AS b(key, rate, burst, n),
+        LATERAL take_rate_limit_token(b.key, b.rate, b.burst) t
+    ORDER BY b.n
+'''
+
+PURGE_IDLE = '''
+    DELETE FROM rate_limits
+    WHERE key IN (
+        SELECT key FROM rate_limits
+        WHERE updated_at < CURRENT_TIMESTAMP - %s * interval '1 second'
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+'''
+
+
+class TokenBucket:
+    '''Локальная копия ведра; после обращения к базе выравнивается по общему остатку'''
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at')
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self, now: float) -> bool:
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def sync(self, remaining: float, now: float) -> None:
+        self.tokens = min(self.tokens, remaining)
+        self.updated_at = now
+
+    def retry_after(self) -> float:
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated_at) * self.rate >= self.burst
+
+
+_buckets: Dict[str, TokenBucket] = {}
+_lock = threading.Lock()
+_shed_until = 0.0
+_load_checked_at = 0.0
+_last_purge = 0.0
+
+
+def client_ip(event: Dict[str, Any]) -> str:
+    '''Адрес клиента из requestContext шлюза; без него - первый адрес X-Forwarded-For'''
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    ip = identity.get('sourceIp') or get_header(event, 'X-Forwarded-For').split(',')[0].strip()
+    return ip or 'unknown'
+
+
+def bucket_key(scope: str, value: str) -> str:
+    '''Ключ ведра; значение хешируется, чтобы телефоны не лежали в rate_limits открытым текстом'''
+    return f'{scope}:{hashlib.sha256(value.encode("utf-8")).hexdigest()[:32]}'
+
+
+def too_many_requests(retry_after: float, reason: str) -> Dict[str, Any]:
+    return json_response(429, {'error': 'Too many requests', 'reason': reason}, headers={
+        'Retry-After': str(max(1, math.ceil(retry_after))),
+        'Access-Control-Expose-Headers': 'Retry-After'
+    })
+
+
+def _local_bucket(key: str, rate: float, burst: float, now: float) -> TokenBucket:
+    bucket = _buckets.get(key)
+    if bucket is None:
+        if len(_buckets) >= MAX_LOCAL_BUCKETS:
+            for stale in [k for k, b in _buckets.items() if b.full(now)]:
+                del _buckets[stale]
+            if len(_buckets) >= MAX_LOCAL_BUCKETS:
+                _buckets.clear()
+        bucket = _buckets[key] = TokenBucket(rate, burst, now)
+    return bucket
+
+
+def _shed(now: float) -> Dict[str, Any]:
+    global _shed_until
+    _shed_until = now + SHED_SECONDS
+    return too_many_requests(SHED_SECONDS, 'overloaded')
+
+
+def admit(event: Optional[Dict[str, Any]], phone: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    '''
+    None, если запрос на запись можно выполнять, иначе готовый ответ 429.
+    Жетон берётся из ведра IP клиента (если передан event) и из ведра телефона (если передан phone),
+    так что телефон можно списать отдельно, когда уже ясно, что запрос не повтор.
+    '''
+    global _load_checked_at, _last_purge
+    now = time.monotonic()
+    if now < _shed_until:
+        return too_many_requests(_shed_until - now, 'overloaded')
+
+    limits: List[Tuple[str, float, float]] = []
+    if event is not None:
+        limits.append((bucket_key('ip', client_ip(event)), IP_RATE, IP_BURST))
+    if phone:
+        limits.append((bucket_key('phone', phone), PHONE_RATE, PHONE_BURST))
+    if not limits:
+        return None
+    limits.sort()
+
+    with _lock:
+        buckets = [_local_bucket(key, rate, burst, now) for key, rate, burst in limits]
+        for bucket in buckets:
+            if not bucket.take(now):
+                return too_many_requests(bucket.retry_after(), 'rate_limited')
+
+    check_load = now - _load_checked_at >= LOAD_CHECK_INTERVAL
+    purge = now - _last_purge >= PURGE_INTERVAL
+    from psycopg2.pool import PoolError
+    try:
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            if check_load:
+                _load_checked_at = now
+                cursor.execute(IN_FLIGHT_QUERY)
+                if cursor.fetchone()['in_flight'] > MAX_IN_FLIGHT:
+                    cursor.close()
+                    return _shed(now)
+            cursor.execute(TAKE_TOKENS, (
+                [key for key, _, _ in limits],
+                [rate for _, rate, _ in limits],
+                [burst for _, _, burst in limits]
+            ))
+            shared = cursor.fetchall()
+            if purge:
+                _last_purge = now
+                cursor.execute(PURGE_IDLE, (PURGE_IDLE_SECONDS, PURGE_BATCH_SIZE))
+            conn.commit()
+            cursor.close()
+    except PoolError:
+        return _shed(now)
+
+    retry_after = None
+    with _lock:
+        for bucket, row in zip(buckets, shared):
+            bucket.sync(row['remaining'], now)
+            if not row['allowed']:
+                retry_after = max(retry_after or 0.0, bucket.retry_after())
+    if retry_after is not None:
+        return too_many_requests(retry_after, 'rate_limited')
+    return None
@@ -0,0 +1,64 @@
+'''
+Кэш сериализованного каталога в памяти тёплого экземпляра функции.
+Запись действительна, пока не истёк TTL и не изменилась версия каталога.
+'''
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+CACHE_TTL = float(os.environ.get('CATALOG_CACHE_TTL', '300'))
+CACHE_MAX_ENTRIES = int(os.environ.get('CATALOG_CACHE_MAX_ENTRIES', '256'))
+
+CacheKey = Tuple[Optional[str], ...]
+
+
+def normalize_key(category: Optional[str], size: Optional[str], search: Optional[str],
+                  cursor: Optional[str] = None) -> CacheKey:
+    category = (category or '').strip()
+    size = (size or '').strip()
+    search = ' '.join((search or '').lower().split())
+    return (
+        category if category and category != 'Все' else None,
+        size if size and size != 'Все' else None,
+        search or None,
+        (cursor or '').strip() or None,
+    )
+
+
+def make_etag(key: CacheKey, version: int) -> str:
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+    return f'"v{version}-{digest}"'
+
+
+class CatalogCache:
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: 'OrderedDict[CacheKey, Tuple[int, float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: CacheKey, version: int) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry_version, stored_at, body = entry
+            if entry_version != version or time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return body
+
+    def put(self, key: CacheKey, version: int, body: Any) -> None:
+        with self._lock:
+            self._entries[key] = (version, time.monotonic(), body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,226 @@
+'''
+Массовая загрузка каталога: CSV или JSON Lines -> COPY во временную таблицу -> upsert по slug.
+Категории разрешаются одним JOIN, slug транслитерируются из названия и
+дедуплицируются внутри загрузки оконной функцией, так что число запросов
+не зависит от числа товаров.
+'''
+import csv
+import io
+import json
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import tracing
+
+TRANSLIT = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh',
+    'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts',
+    'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu',
+    'я': 'ya'
+}
+TRANSLIT_TABLE = str.maketrans(TRANSLIT)
+SLUG_PATTERN = re.compile(r'[^a-z0-9]+')
+MAX_SLUG_LENGTH = 200
+
+IMPORT_COLUMNS = (
+    'line_no', 'name', 'slug', 'base_slug', 'description', 'price', 'old_price',
+    'category', 'image_url', 'badge', 'sizes', 'size_low', 'size_high', 'is_active'
+)
+
+CREATE_STAGING_TABLE = '''
+    CREATE TEMP TABLE product_import (
+        line_no INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        slug TEXT,
+        base_slug TEXT NOT NULL,
+        description TEXT,
+        price NUMERIC(10, 2) NOT NULL,
+        old_price NUMERIC(10, 2),
+        category TEXT NOT NULL,
+        image_url TEXT,
+        badge TEXT,
+        sizes TEXT,
+        size_low INTEGER,
+        size_high INTEGER,
+        is_active BOOLEAN
+    ) ON COMMIT DROP
+'''
+
+COPY_STAGING = f"COPY product_import ({', '.join(IMPORT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+
+ASSIGN_SLUGS = '''
+    UPDATE product_import s
+    SET slug = d.slug
+    FROM (
+        SELECT line_no, base_slug || CASE
+            WHEN row_number() OVER w > 1 THEN '-' || row_number() OVER w
+            ELSE ''
+        END AS slug
+        FROM product_import
+        WHERE slug IS NULL
+        WINDOW w AS (PARTITION BY base_slug ORDER BY line_no)
+    ) d
+    WHERE s.line_no = d.line_no
+'''
+
+UNKNOWN_CATEGORIES = '''
+    SELECT s.line_no, s.category
+    FROM product_import s
+    LEFT JOIN categories c ON c.name = s.category
+    WHERE c.id IS NULL
+    ORDER BY s.line_no
+'''
+
+SUPERSEDED_SLUGS = '''
+    SELECT line_no, slug
+    FROM (
+        SELECT s.line_no, s.slug, row_number() OVER (PARTITION BY s.slug ORDER BY s.line_no DESC) AS n
+        FROM product_import s
+        JOIN categories c ON c.name = s.category
+    ) d
+    WHERE n > 1
+    ORDER BY line_no
+'''
+
+UPSERT_PRODUCTS = '''
+    WITH upserted AS (
+        INSERT INTO products (
+            name, slug, description, price, old_price, category_id,
+            image_url, badge, sizes, size_range, is_active
+        )
+        SELECT DISTINCT ON (s.slug)
+            s.name, s.slug, s.description, s.price, s.old_price, c.id,
+            s.image_url, s.badge, s.sizes,
+            CASE WHEN s.size_low IS NOT NULL THEN int4range(s.size_low, s.size_high, '[]') END,
+            coalesce(s.is_active, true)
+        FROM product_import s
+        JOIN categories c ON c.name = s.category
+        ORDER BY s.slug, s.line_no DESC
+        ON CONFLICT (slug) DO UPDATE SET
+            name = EXCLUDED.name,
+            description = EXCLUDED.description,
+            price = EXCLUDED.price,
+            old_price = EXCLUDED.old_price,
+            category_id = EXCLUDED.category_id,
+            image_url = EXCLUDED.image_url,
+            badge = EXCLUDED.badge,
+            sizes = EXCLUDED.sizes,
+            size_range = EXCLUDED.size_range,
+            is_active = EXCLUDED.is_active,
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING (xmax = 0) AS inserted
+    )
+    SELECT
+        count(*) FILTER (WHERE inserted) AS created,
+        count(*) FILTER (WHERE NOT inserted) AS updated
+    FROM upserted
+'''
+
+
+def slugify(name: str) -> str:
+    '''Транслитерированный slug: "Платье \"Элегант\"" -> "plate-elegant"'''
+    slug = SLUG_PATTERN.sub('-', name.lower().translate(TRANSLIT_TABLE)).strip('-')
+    return slug[:MAX_SLUG_LENGTH].rstrip('-') or 'product'
+
+
+def unique_slug(cursor: Any, base: str) -> str:
+    '''Первый свободный slug из base, base-2, base-3, ... для одиночного создания товара'''
+    cursor.execute(
+        'SELECT slug FROM products WHERE slug = %s OR slug LIKE %s',
+        (base, base + '-%')
+    )
+    taken = {row['slug'] for row in cursor.fetchall()}
+    if base not in taken:
+        return base
+    suffix = 2
+    while f'{base}-{suffix}' in taken:
+        suffix += 1
+    return f'{base}-{suffix}'
+
+
+def read_records(body: str, fmt: str) -> Iterator[Tuple[int, Optional[Dict[str, Any]]]]:
+    '''Записи загрузки с номером строки: CSV с заголовком или JSON Lines (None для нечитаемой строки)'''
+    if fmt == 'csv':
+        reader = csv.DictReader(io.StringIO(body))
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_no, line in enumerate(body.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_no, record if isinstance(record, dict) else None
+
+
+class RowStream(io.RawIOBase):
+    '''Файловый объект для copy_expert: CSV формируется по мере чтения, без сборки всего тела в памяти'''
+
+    def __init__(self, rows: Iterable[Tuple[Any, ...]]) -> None:
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        self._pending = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._pending) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._writer.writerow(row)
+            self._pending += self._buffer.getvalue().encode('utf-8')
+            self._buffer.seek(0)
+            self._buffer.truncate()
+        if size < 0:
+            size = len(self._pending)
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        return chunk
+
+
+def import_catalog(cursor: Any, rows: Iterable[Tuple[Any, ...]]) -> Tuple[Dict[str, int], List[Dict[str, Any]]]:
+    '''
+    Загружает подготовленные строки (в порядке IMPORT_COLUMNS) и делает upsert по slug.
+    Возвращает счётчики created/updated и отклонённые строки: с неизвестной категорией
+    и те, чей slug повторяется в более поздней строке (загружается последняя).
+    '''
+    cursor.execute(CREATE_STAGING_TABLE)
+    with tracing.phase('copy'):
+        cursor.copy_expert(COPY_STAGING, RowStream(rows))
+    cursor.execute(ASSIGN_SLUGS)
+    cursor.execute(UNKNOWN_CATEGORIES)
+    rejected = [
+        {'line': row['line_no'], 'error': f'Category "{row["category"]}" not found'}
+        for row in cursor.fetchall()
+    ]
+    cursor.execute(SUPERSEDED_SLUGS)
+    rejected += [
+        {'line': row['line_no'], 'error': f'Slug "{row["slug"]}" is reused by a later line'}
+        for row in cursor.fetchall()
+    ]
+    cursor.execute(UPSERT_PRODUCTS)
+    counts = dict(cursor.fetchone())
+    return counts, rejected
+
+
+def staged_row(line_no: int, record: Dict[str, Any], size_bounds: Optional[Tuple[int, int]]) -> Tuple[Any, ...]:
+    '''Строка для COPY в порядке IMPORT_COLUMNS; поля уже проверены вызывающим кодом'''
+    low, high = size_bounds or (None, None)
+    sizes = None
+    if size_bounds:
+        sizes = f'{low}-{high}' if low != high else str(low)
+    slug = (record.get('slug') or '').strip() or None
+    is_active = record.get('is_active')
+    if isinstance(is_active, str):
+        is_active = is_active.strip().lower() in ('1', 'true', 't', 'yes') if is_active.strip() else None
+    return (
+        line_no, record['name'], slug, slugify(record['name']), record.get('description') or None,
+        record['price'], record.get('old_price') or None, record['category'],
+        record.get('image_url') or None, record.get('badge') or None,
+        sizes, low, high, is_active
+    )
@@ -1,32 +1,354 @@
+import base64
 import json
-import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from decimal import Decimal
-from typing import Dict, Any
+import math
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional, Tuple
 
+import admission
+import db
+import tracing
+from catalog_cache import CatalogCache, normalize_key, make_etag
+from catalog_import import import_catalog, read_records, slugify, staged_row, unique_slug
+from responses import json_response, encoded_response, dumps, compress, negotiate_encoding, get_header
+
+OPTIONS_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, If-None-Match, X-Read-After',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': ''
+}
+
+METHOD_NOT_ALLOWED_RESPONSE = json_response(405, {'error': 'Method not allowed'})
+
+CATALOG_QUERY = '''
+    SELECT 
+        p.id, p.name, p.slug, p.description, p.price, p.old_price,
+        p.image_url, p.badge, p.sizes, c.name as category, p.created_at
+    FROM products p
+    LEFT JOIN categories c ON p.category_id = c.id
+    WHERE p.is_active = true
+'''
+
+CATALOG_ORDER = ' ORDER BY p.created_at DESC, p.id DESC'
+
+SEARCH_QUERY = '''
+    SELECT * FROM (
+        SELECT 
+            p.id, p.name, p.slug, p.description, p.price, p.old_price,
+            p.image_url, p.badge, p.sizes, c.name as category,
+            (ts_rank(p.search_vector, to_tsquery('russian', %(tsquery)s))
+                + word_similarity(%(search)s, p.name))::float8 AS rank
+        FROM products p
+        LEFT JOIN categories c ON p.category_id = c.id
+        WHERE p.is_active = true
+            AND (p.search_vector @@ to_tsquery('russian', %(tsquery)s) OR %(search)s <%% p.name)
+            {filters}
+    ) ranked
+    {after}
+    ORDER BY rank DESC, id DESC
+    LIMIT %(limit)s
+'''
+
+FACETS_QUERY = '''
+    WITH base AS (
+        SELECT p.id, c.name AS category, p.size_range
+        FROM products p
+        LEFT JOIN categories c ON p.category_id = c.id
+        WHERE p.is_active = true
+            {search}
+    )
+    SELECT
+        GROUPING(base.category) = 1 AS by_size,
+        base.category,
+        size,
+        count(DISTINCT base.id) FILTER (
+            WHERE %(size)s::int4 IS NULL OR base.size_range @> %(size)s::int4
+        ) AS category_count,
+        count(DISTINCT base.id) FILTER (
+            WHERE %(category)s::text IS NULL OR base.category = %(category)s::text
+        ) AS size_count
+    FROM base
+    LEFT JOIN LATERAL generate_series(lower(base.size_range), upper(base.size_range) - 1, 2) AS size ON true
+    GROUP BY GROUPING SETS ((base.category), (size))
+'''
+
+FACETS_SEARCH_CLAUSE = "AND (p.search_vector @@ to_tsquery('russian', %(tsquery)s) OR %(search)s <%% p.name)"
+
+SIZES_PATTERN = re.compile(r'^\s*(\d{2,3})\s*(?:[-–]\s*(\d{2,3}))?\s*$')
+MIN_SIZE = 30
+MAX_SIZE = 90
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+IMPORT_FORMATS = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson'
+}
+SLUG_FORMAT = re.compile(r'^[a-z0-9]+(?:-[a-z0-9]+)*$')
+FIELD_MAX_LENGTHS = {'name': 255, 'slug': 255, 'badge': 50, 'category': 100}
+MAX_PRICE = Decimal('99999999.99')
+MAX_REPORTED_ERRORS = 100
+
+db.register_statement('catalog_list', CATALOG_QUERY + CATALOG_ORDER + ' LIMIT $1')
+db.register_statement('catalog_version', 'SELECT version FROM catalog_version WHERE id = 1')
+
+BUMP_CATALOG_VERSION = '''
+    UPDATE catalog_version 
+    SET version = version + 1, updated_at = CURRENT_TIMESTAMP 
+    WHERE id = 1
+'''
+
+catalog_cache = CatalogCache()
+
+def encode_cursor(values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+def cursor_timestamp(value: Any) -> datetime:
+    if not isinstance(value, str):
+        raise ValueError('cursor timestamp must be a string')
+    return datetime.fromisoformat(value)
+
+def cursor_rank(value: Any) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError('cursor rank must be a number')
+    return float(value)
+
+def decode_cursor(cursor: str, key: Callable[[Any], Any] = cursor_timestamp) -> List[Any]:
+    '''Ключ (значение сортировки, id) из курсора; значение разбирается функцией key, битый курсор - ValueError'''
+    padded = cursor + '=' * (-len(cursor) % 4)
+    values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('cursor must hold two values')
+    if isinstance(values[1], bool) or not isinstance(values[1], int):
+        raise ValueError('cursor id must be an integer')
+    return [key(values[0]), values[1]]
+
+def parse_limit(raw: Optional[str], default: int = DEFAULT_PAGE_SIZE) -> int:
+    if not raw:
+        return default
+    limit = int(raw)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, MAX_PAGE_SIZE)
+
+def parse_sizes(raw: Any) -> Optional[Tuple[int, int]]:
+    '''
+    Разбирает строку размеров вида "50-62" или "52" в границы диапазона (включительно).
+    Размерная сетка чётная, поэтому нечётные границы отклоняются: иначе фасеты давали бы размеры 49, 51, ...
+    '''
+    if raw is None or str(raw).strip() == '':
+        return None
+    match = SIZES_PATTERN.match(str(raw))
+    if not match:
+        raise ValueError(f'Invalid sizes "{raw}", expected "50-62" or "52"')
+    low = int(match.group(1))
+    high = int(match.group(2) or low)
+    if low > high or low < MIN_SIZE or high > MAX_SIZE:
+        raise ValueError(f'Invalid sizes "{raw}", expected a range within {MIN_SIZE}-{MAX_SIZE}')
+    if low % 2 or high % 2:
+        raise ValueError(f'Invalid sizes "{raw}", expected even sizes such as "48-56"')
+    return low, high
+
+def parse_size_filter(raw: Optional[str]) -> Optional[int]:
+    if not raw:
+        return None
+    return int(raw)
+
+def to_prefix_tsquery(search: str) -> str:
+    '''Каждое слово запроса ищется как префикс: "элег плат" -> "элег:* & плат:*"'''
+    return ' & '.join(f'{word}:*' for word in re.findall(r'\w+', search))
+
+def filter_clauses(category: Optional[str], size: Optional[int], query_params: Dict[str, Any]) -> str:
+    clauses = []
+    if category:
+        clauses.append('AND c.name = %(category)s')
+        query_params['category'] = category
+    if size:
+        clauses.append('AND p.size_range @> %(size)s::int4')
+        query_params['size'] = size
+    return ' '.join(clauses)
+
+def search_products(cursor: Any, category: Optional[str], size: Optional[int], search: str,
+                    limit: int, after: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    '''Ранжированный поиск: полнотекстовый по префиксам слов плюс триграммная похожесть запроса на часть названия (word_similarity)'''
+    query_params: Dict[str, Any] = {
+        'tsquery': to_prefix_tsquery(search),
+        'search': search,
+        'limit': limit + 1
+    }
+    after_clause = ''
+    if after:
+        query_params['after_rank'], query_params['after_id'] = decode_cursor(after, cursor_rank)
+        after_clause = 'WHERE (rank, id) < (%(after_rank)s::float8, %(after_id)s)'
+    
+    cursor.execute(SEARCH_QUERY.format(
+        filters=filter_clauses(category, size, query_params),
+        after=after_clause
+    ), query_params)
+    rows = [dict(row) for row in cursor.fetchall()]
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1]['rank'], rows[-1]['id']])
+    for row in rows:
+        del row['rank']
+    return rows, next_cursor
+
+def list_products(cursor: Any, category: Optional[str], size: Optional[int],
+                  limit: int, after: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    '''Страница каталога по ключу (created_at, id): стоимость любой страницы равна стоимости первой'''
+    if not category and not size and not after:
+        db.execute_prepared(cursor, 'catalog_list', (limit + 1,))
+    else:
+        query_params: Dict[str, Any] = {'limit': limit + 1}
+        query = CATALOG_QUERY + filter_clauses(category, size, query_params)
+        if after:
+            query_params['after_created_at'], query_params['after_id'] = decode_cursor(after)
+            query += ' AND (p.created_at, p.id) < (%(after_created_at)s::timestamp, %(after_id)s)'
+        cursor.execute(query + CATALOG_ORDER + ' LIMIT %(limit)s', query_params)
+    rows = [dict(row) for row in cursor.fetchall()]
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1]['created_at'].isoformat(), rows[-1]['id']])
+    for row in rows:
+        del row['created_at']
+    return rows, next_cursor
+
+def catalog_facets(cursor: Any, category: Optional[str], size: Optional[int],
+                   search: Optional[str]) -> Dict[str, List[Dict[str, Any]]]:
+    '''
+    Счётчики для фильтров каталога одним запросом с GROUPING SETS.
+    Счётчик категории учитывает поиск и фильтр размера, счётчик размера - поиск и фильтр категории,
+    так что каждое значение показывает, сколько товаров останется после его выбора.
+    '''
+    query_params: Dict[str, Any] = {'category': category, 'size': size}
+    search_clause = ''
+    if search:
+        query_params['tsquery'] = to_prefix_tsquery(search)
+        query_params['search'] = search
+        search_clause = FACETS_SEARCH_CLAUSE
+    cursor.execute(FACETS_QUERY.format(search=search_clause), query_params)
+    
+    categories = []
+    sizes = []
+    for row in cursor.fetchall():
+        if row['by_size'] and row['size'] is not None and row['size_count']:
+            sizes.append({'size': row['size'], 'count': row['size_count']})
+        elif not row['by_size'] and row['category'] is not None and row['category_count']:
+            categories.append({'name': row['category'], 'count': row['category_count']})
+    categories.sort(key=lambda facet: (-facet['count'], facet['name']))
+    sizes.sort(key=lambda facet: facet['size'])
+    return {'categories': categories, 'sizes': sizes}
+
+def import_format(event: Dict[str, Any]) -> Optional[str]:
+    '''Формат массовой загрузки по ?format=csv|ndjson или Content-Type; None для обычного JSON'''
+    fmt = (event.get('queryStringParameters') or {}).get('format')
+    if fmt in ('csv', 'ndjson'):
+        return fmt
+    content_type = get_header(event, 'Content-Type').split(';')[0].strip().lower()
+    return IMPORT_FORMATS.get(content_type)
+
+def parse_price(raw: Any, field: str, allow_zero: bool = False) -> Decimal:
+    '''Цена, помещающаяся в NUMERIC(10, 2) после округления до копеек'''
+    if isinstance(raw, bool):
+        raise ValueError(f'Invalid {field}')
+    try:
+        price = Decimal(str(raw).strip()).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError(f'Invalid {field}')
+    if not price.is_finite():
+        raise ValueError(f'Invalid {field}')
+    if price > MAX_PRICE or price < 0 or (price == 0 and not allow_zero):
+        raise ValueError(f'Invalid {field}, expected a number between 0 and {MAX_PRICE}')
+    return price
+
+def validate_record(record: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+    '''Проверяет типы и границы полей записи загрузки по схеме products; возвращает границы размеров'''
+    for field in ('name', 'category', 'slug', 'description', 'image_url', 'badge'):
+        if record.get(field) is not None and not isinstance(record[field], str):
+            raise ValueError(f'Field {field} must be a string')
+    if not (record.get('name') or '').strip() or record.get('price') in (None, '') or not record.get('category'):
+        raise ValueError('Missing required fields: name, price, category')
+    for field, max_length in FIELD_MAX_LENGTHS.items():
+        if len(record.get(field) or '') > max_length:
+            raise ValueError(f'Field {field} must be at most {max_length} characters')
+    parse_price(record['price'], 'price')
+    if record.get('old_price') not in (None, ''):
+        parse_price(record['old_price'], 'old_price', allow_zero=True)
+    slug = (record.get('slug') or '').strip()
+    if slug and not SLUG_FORMAT.match(slug):
+        raise ValueError(f'Invalid slug "{slug}"')
+    if record.get('is_active') is not None and not isinstance(record['is_active'], (bool, str)):
+        raise ValueError('Field is_active must be a boolean')
+    return parse_sizes(record.get('sizes'))
+
+def validated_rows(records: Iterable[Tuple[int, Optional[Dict[str, Any]]]], rejected: List[Dict[str, Any]]) -> Iterator[Tuple[Any, ...]]:
+    '''Проверяет записи загрузки на лету; некорректные попадают в rejected и не идут в COPY'''
+    for line_no, record in records:
+        if record is None:
+            rejected.append({'line': line_no, 'error': 'Invalid JSON object'})
+            continue
+        try:
+            size_bounds = validate_record(record)
+        except ValueError as e:
+            rejected.append({'line': line_no, 'error': str(e)})
+            continue
+        yield staged_row(line_no, record, size_bounds)
+
+@tracing.traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: API для получения списка товаров с фильтрацией
-    Args: event - dict с httpMethod, queryStringParameters (category, size, search)
+    Args: event - dict с httpMethod, queryStringParameters (category, size, search, limit, cursor, facets=1);
+                  POST с Content-Type text/csv или application/x-ndjson (или ?format=csv|ndjson) - массовая загрузка
           context - объект с атрибутами request_id, function_name
-    Returns: HTTP response с JSON списком товаров
+    Returns: HTTP response с JSON списком товаров; 429 с Retry-After при превышении лимита записей
     '''
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return OPTIONS_RESPONSE
     
-    database_url = os.environ.get('DATABASE_URL')
+    if method not in ('GET', 'POST', 'PUT'):
+        return METHOD_NOT_ALLOWED_RESPONSE
+    
+    if method in ('POST', 'PUT'):
+        throttled = admission.admit(event)
+        if throttled is not None:
+            return throttled
+    
+    if method == 'POST' and import_format(event):
+        body = event.get('body') or ''
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body).decode('utf-8')
+        
+        rejected: List[Dict[str, Any]] = []
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            counts, unknown = import_catalog(cursor, validated_rows(read_records(body, import_format(event)), rejected))
+            if counts['created'] or counts['updated']:
+                cursor.execute(BUMP_CATALOG_VERSION)
+            conn.commit()
+            position = db.write_position(cursor)
+            cursor.close()
+        
+        rejected = sorted(rejected + unknown, key=lambda item: item['line'])
+        return json_response(200, {
+            **counts,
+            'rejected': rejected[:MAX_REPORTED_ERRORS],
+            'rejected_count': len(rejected)
+        }, event, db.read_after_headers(position))
     
     if method == 'POST':
         body_data = json.loads(event.get('body', '{}'))
@@ -38,54 +360,49 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         category = body_data.get('category')
         image_url = body_data.get('image_url', '')
         badge = body_data.get('badge')
-        sizes = body_data.get('sizes', '')
+        sizes_input = body_data.get('sizes', '')
         
         if not name or not price or not category:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps({'error': 'Missing required fields: name, price, category'})
-            }
+            return json_response(400, {'error': 'Missing required fields: name, price, category'})
         
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        try:
+            size_bounds = parse_sizes(sizes_input)
+        except ValueError as e:
+            return json_response(400, {'error': str(e)})
         
-        import re
-        slug = re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+        sizes = None
+        size_range = None
+        if size_bounds:
+            low, high = size_bounds
+            sizes = f'{low}-{high}' if low != high else str(low)
+            from psycopg2.extras import NumericRange
+            size_range = NumericRange(low, high, '[]')
         
-        cursor.execute("SELECT id FROM categories WHERE name = %s", (category,))
-        category_result = cursor.fetchone()
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("SELECT id FROM categories WHERE name = %s", (category,))
+            category_result = cursor.fetchone()
+            
+            if category_result:
+                slug = unique_slug(cursor, slugify(name))
+                cursor.execute('''
+                    INSERT INTO products (name, slug, description, price, old_price, category_id, image_url, badge, sizes, size_range)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                ''', (name, slug, description, price, old_price, category_result['id'], image_url, badge, sizes, size_range))
+                
+                product_id = cursor.fetchone()['id']
+                cursor.execute(BUMP_CATALOG_VERSION)
+                conn.commit()
+                position = db.write_position(cursor)
+            cursor.close()
         
         if not category_result:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps({'error': f'Category "{category}" not found'})
-            }
-        
-        category_id = category_result['id']
-        
-        cursor.execute('''
-            INSERT INTO products (name, slug, description, price, old_price, category_id, image_url, badge, sizes)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        ''', (name, slug, description, price, old_price, category_id, image_url, badge, sizes))
-        
-        product_id = cursor.fetchone()['id']
-        conn.commit()
-        cursor.close()
-        conn.close()
+            return json_response(400, {'error': f'Category "{category}" not found'})
         
-        return {
-            'statusCode': 201,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({'product_id': product_id, 'message': 'Product created successfully'})
-        }
+        return json_response(201, {'product_id': product_id, 'message': 'Product created successfully'},
+                             headers=db.read_after_headers(position))
     
     if method == 'PUT':
         body_data = json.loads(event.get('body', '{}'))
@@ -94,93 +411,77 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         is_active = body_data.get('is_active')
         
         if product_id is None:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps({'error': 'Missing product id'})
-            }
-        
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE products 
-            SET is_active = %s, updated_at = CURRENT_TIMESTAMP 
-            WHERE id = %s
-        ''', (is_active, product_id))
+            return json_response(400, {'error': 'Missing product id'})
         
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE products 
+                SET is_active = %s, updated_at = CURRENT_TIMESTAMP 
+                WHERE id = %s
+            ''', (is_active, product_id))
+            cursor.execute(BUMP_CATALOG_VERSION)
+            
+            conn.commit()
+            position = db.write_position(cursor)
+            cursor.close()
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({'message': 'Product updated successfully'})
-        }
-    
-    if method != 'GET':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+        return json_response(200, {'message': 'Product updated successfully'}, headers=db.read_after_headers(position))
     
     params = event.get('queryStringParameters') or {}
-    category = params.get('category')
-    size = params.get('size')
-    search = params.get('search')
-    
-    conn = psycopg2.connect(database_url)
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    query = '''
-        SELECT 
-            p.id, p.name, p.slug, p.description, p.price, p.old_price,
-            p.image_url, p.badge, p.sizes, c.name as category
-        FROM products p
-        LEFT JOIN categories c ON p.category_id = c.id
-        WHERE p.is_active = true
-    '''
-    
-    conditions = []
-    
-    if category and category != 'Все':
-        conditions.append(f"c.name = '{category}'")
-    
-    if size and size != 'Все':
-        conditions.append(f"p.sizes LIKE '%{size}%'")
-    
-    if search:
-        conditions.append(f"(p.name ILIKE '%{search}%' OR p.description ILIKE '%{search}%')")
-    
-    if conditions:
-        query += ' AND ' + ' AND '.join(conditions)
+    category, size, search, after = cache_key = normalize_key(
+        params.get('category'), params.get('size'), params.get('search'), params.get('cursor')
+    )
     
-    query += ' ORDER BY p.created_at DESC'
+    try:
+        limit = parse_limit(params.get('limit'), DEFAULT_PAGE_SIZE if search else MAX_PAGE_SIZE)
+        size = parse_size_filter(size)
+        if after:
+            decode_cursor(after, cursor_rank if search else cursor_timestamp)
+    except (ValueError, TypeError):
+        return json_response(400, {'error': 'Invalid limit, size or cursor'})
+    with_facets = params.get('facets') in ('1', 'true')
+    cache_key += (limit, with_facets)
     
-    cursor.execute(query)
-    products = cursor.fetchall()
-    
-    cursor.close()
-    conn.close()
-    
-    def decimal_to_float(obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        raise TypeError
-    
-    products_list = [dict(row) for row in products]
+    with db.connection(readonly=True, read_after=db.parse_read_after(get_header(event, db.READ_AFTER_HEADER))) as conn:
+        cursor = conn.cursor()
+        
+        db.execute_prepared(cursor, 'catalog_version')
+        version = cursor.fetchone()['version']
+        etag = make_etag(cache_key, version)
+        response_headers = {
+            'Access-Control-Expose-Headers': 'ETag',
+            'Cache-Control': 'no-cache',
+            'ETag': etag
+        }
+        
+        if etag in get_header(event, 'If-None-Match'):
+            cursor.close()
+            return encoded_response(304, b'', None, response_headers)
+        
+        bodies = catalog_cache.get(cache_key, version)
+        if bodies is None:
+            if search:
+                products, next_cursor = search_products(cursor, category, size, search, limit, after)
+            else:
+                products, next_cursor = list_products(cursor, category, size, limit, after)
+            payload = {'products': products, 'next_cursor': next_cursor}
+            
+            if with_facets:
+                facets_key = ('facets', category, size, search)
+                facets = catalog_cache.get(facets_key, version)
+                if facets is None:
+                    facets = catalog_facets(cursor, category, size, search)
+                    catalog_cache.put(facets_key, version, facets)
+                payload['facets'] = facets
+            
+            bodies = {None: dumps(payload)}
+            catalog_cache.put(cache_key, version, bodies)
+        
+        cursor.close()
     
-    return {
-        'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'isBase64Encoded': False,
-        'body': json.dumps({'products': products_list}, ensure_ascii=False, default=decimal_to_float)
-    }
\ No newline at end of file
+    encoding = negotiate_encoding(event, bodies[None])
+    if encoding not in bodies:
+        bodies[encoding] = compress(bodies[None], encoding)
+    return encoded_response(200, bodies[encoding], encoding, response_headers)
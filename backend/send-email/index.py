@@ -1,70 +1,124 @@
 import json
 import os
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from typing import Dict, Any
+import time
+from types import ModuleType
+from typing import TYPE_CHECKING, Dict, Any, Optional
 
+from responses import json_response
+import tracing
+
+if TYPE_CHECKING:
+    from email.mime.multipart import MIMEMultipart
+
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', '30'))
+SMTP_MAX_PER_SESSION = int(os.environ.get('SMTP_MAX_PER_SESSION', '100'))
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') != '0'
+MAX_BATCH_MESSAGES = int(os.environ.get('SMTP_MAX_BATCH_MESSAGES', '100'))
+
+OPTIONS_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': ''
+}
+
+METHOD_NOT_ALLOWED_RESPONSE = json_response(405, {'error': 'Method not allowed'})
+
+@tracing.traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Отправка email уведомлений о заказах
-    Args: event - dict с httpMethod, body (to, subject, html, text)
+    Args: event - dict с httpMethod, body (to, subject, html, text) или пачка
+                  писем: массив либо {"messages": [...], "time_budget": секунды} с теми же полями;
+                  после time_budget новые письма пачки не начинаются и возвращаются как failed
           context - объект с атрибутами request_id, function_name
     Returns: HTTP response с результатом отправки
     '''
     method: str = event.get('httpMethod', 'POST')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return OPTIONS_RESPONSE
     
     if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+        return METHOD_NOT_ALLOWED_RESPONSE
     
     body_data = json.loads(event.get('body', '{}'))
     
+    smtp_host = os.environ.get('SMTP_HOST')
+    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
+    smtp_user = os.environ.get('SMTP_USER')
+    smtp_password = os.environ.get('SMTP_PASSWORD')
+    
+    if isinstance(body_data, list) or 'messages' in body_data:
+        messages = body_data if isinstance(body_data, list) else body_data.get('messages') or []
+        if not isinstance(messages, list) or len(messages) > MAX_BATCH_MESSAGES:
+            return json_response(400, {'error': f'messages must be a list of at most {MAX_BATCH_MESSAGES} messages'})
+        
+        if not smtp_host or not smtp_user or not smtp_password:
+            return json_response(500, {'error': 'SMTP configuration is missing'})
+        
+        try:
+            time_budget = float(body_data.get('time_budget') or 0) if isinstance(body_data, dict) else 0.0
+        except (TypeError, ValueError):
+            return json_response(400, {'error': 'time_budget must be a number of seconds'})
+        deadline = time.monotonic() + time_budget if time_budget > 0 else None
+        
+        session = SmtpSession(smtp_host, smtp_port, smtp_user, smtp_password)
+        results = []
+        with tracing.phase('smtp'):
+            try:
+                for message in messages:
+                    if deadline is not None and time.monotonic() > deadline:
+                        results.append(not_sent(message, 'Batch time budget exceeded'))
+                        continue
+                    results.append(send_batch_message(session, message))
+            finally:
+                session.close()
+        
+        return json_response(200, {
+            'sent': sum(1 for result in results if result['status'] == 'sent'),
+            'failed': sum(1 for result in results if result['status'] == 'failed'),
+            'results': results
+        })
+    
     to_email = body_data.get('to')
     subject = body_data.get('subject')
     html_content = body_data.get('html')
     text_content = body_data.get('text', '')
     
     if not to_email or not subject or not html_content:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({'error': 'Missing required fields: to, subject, html'})
-        }
-    
-    smtp_host = os.environ.get('SMTP_HOST')
-    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-    smtp_user = os.environ.get('SMTP_USER')
-    smtp_password = os.environ.get('SMTP_PASSWORD')
+        return json_response(400, {'error': 'Missing required fields: to, subject, html'})
     
     if not smtp_host or not smtp_user or not smtp_password:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({'error': 'SMTP configuration is missing'})
-        }
+        return json_response(500, {'error': 'SMTP configuration is missing'})
+    
+    msg = build_message(smtp_user, to_email, subject, html_content, text_content)
+    
+    session = SmtpSession(smtp_host, smtp_port, smtp_user, smtp_password)
+    with tracing.phase('smtp'):
+        try:
+            session.send(msg)
+        finally:
+            session.close()
+    
+    return json_response(200, {'message': 'Email sent successfully'})
+
+def load_smtplib() -> ModuleType:
+    '''smtplib тянет за собой ssl и socket, поэтому загружается при первой отправке, а не на холодном старте'''
+    import smtplib
+    return smtplib
+
+def build_message(from_email: str, to_email: str, subject: str, html_content: str, text_content: str = '') -> 'MIMEMultipart':
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
     
     msg = MIMEMultipart('alternative')
     msg['Subject'] = subject
-    msg['From'] = smtp_user
+    msg['From'] = from_email
     msg['To'] = to_email
     
     if text_content:
@@ -73,16 +127,102 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     part_html = MIMEText(html_content, 'html', 'utf-8')
     msg.attach(part_html)
+    return msg
+
+class SmtpSessionFailed(Exception):
+    '''Сессия уже не смогла подключиться или авторизоваться в этой пачке'''
+
+class SmtpSession:
+    '''
+    Одна авторизованная SMTP-сессия на пачку писем.
+    Переподключается, если сервер оборвал соединение, и после SMTP_MAX_PER_SESSION писем.
+    Ошибка подключения или авторизации запоминается в error: остаток пачки не отправляется
+    и не авторизуется заново, чтобы неверный пароль не стоил по попытке AUTH на письмо.
+    '''
+    
+    def __init__(self, host: str, port: int, user: str, password: str) -> None:
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.server = None
+        self.sent_in_session = 0
+        self.error: Optional[str] = None
+    
+    def connect(self) -> None:
+        smtplib = load_smtplib()
+        self.close()
+        if self.error is not None:
+            raise SmtpSessionFailed(self.error)
+        try:
+            server = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        except (smtplib.SMTPException, OSError) as e:
+            self.error = f'{type(e).__name__}: {e}'
+            raise
+        try:
+            if SMTP_STARTTLS:
+                server.starttls()
+            server.login(self.user, self.password)
+        except (smtplib.SMTPException, OSError) as e:
+            server.close()
+            self.error = f'{type(e).__name__}: {e}'
+            raise
+        self.server = server
+        self.sent_in_session = 0
+    
+    def close(self) -> None:
+        smtplib = load_smtplib()
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+        self.server = None
+    
+    def send(self, msg: 'MIMEMultipart') -> None:
+        smtplib = load_smtplib()
+        if self.server is None or self.sent_in_session >= SMTP_MAX_PER_SESSION:
+            self.connect()
+        try:
+            self.server.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            self.connect()
+            self.server.send_message(msg)
+        self.sent_in_session += 1
+
+def not_sent(message: Dict[str, Any], error: str) -> Dict[str, Any]:
+    result: Dict[str, Any] = {'to': message.get('to'), 'status': 'failed', 'error': error}
+    if 'id' in message:
+        result['id'] = message['id']
+    return result
+
+def send_batch_message(session: SmtpSession, message: Dict[str, Any]) -> Dict[str, Any]:
+    to_email = message.get('to')
+    subject = message.get('subject')
+    html_content = message.get('html')
+    smtplib = load_smtplib()
+    result: Dict[str, Any] = {'to': to_email, 'status': 'sent'}
+    if 'id' in message:
+        result['id'] = message['id']
+    
+    if not to_email or not subject or not html_content:
+        result.update(status='failed', error='Missing required fields: to, subject, html')
+        return result
+    
+    if session.error is not None:
+        result.update(status='failed', error=f'SMTP session failed: {session.error}')
+        return result
     
-    server = smtplib.SMTP(smtp_host, smtp_port)
-    server.starttls()
-    server.login(smtp_user, smtp_password)
-    server.send_message(msg)
-    server.quit()
-    
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'isBase64Encoded': False,
-        'body': json.dumps({'message': 'Email sent successfully'})
-    }
+    try:
+        session.send(build_message(session.user, to_email, subject, html_content, message.get('text', '')))
+    except SmtpSessionFailed as e:
+        result.update(status='failed', error=f'SMTP session failed: {e}')
+    except smtplib.SMTPRecipientsRefused as e:
+        result.update(status='failed', error=f'Recipient refused: {e.recipients}')
+    except smtplib.SMTPResponseException as e:
+        result.update(status='failed', error=f'SMTP {e.smtp_code}: {e.smtp_error!r}')
+    except (smtplib.SMTPException, OSError) as e:
+        session.close()
+        result.update(status='failed', error=f'{type(e).__name__}: {e}')
+    return result
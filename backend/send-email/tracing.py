@@ -0,0 +1,156 @@
+'''
+Лёгкая трассировка вызова функции по фазам.
+Время фаз (подключение к БД, SQL, сериализация и т.п.), число SQL-запросов и строк
+пишется одной JSON-строкой в stdout с request_id вызова для доли TRACE_SAMPLE_RATE
+вызовов (по умолчанию 1%); у остальных каждая точка замера сводится к одной проверке
+contextvar. Заголовок Server-Timing раскрывает внутренние тайминги клиенту, поэтому
+добавляется только при TRACE_SERVER_TIMING=1.
+'''
+import functools
+import json
+import os
+import random
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+SLOW_QUERY_MS = float(os.environ.get('TRACE_SLOW_QUERY_MS', '200'))
+LOG_ENABLED = os.environ.get('TRACE_LOG', '1') != '0'
+SERVER_TIMING = os.environ.get('TRACE_SERVER_TIMING', '0') == '1'
+MAX_SLOW_QUERIES = 10
+
+_current: ContextVar[Optional['Trace']] = ContextVar('trace', default=None)
+_traced_cursors: Dict[type, type] = {}
+
+
+class Trace:
+    def __init__(self, request_id: str, function_name: str, method: str) -> None:
+        self.request_id = request_id
+        self.function_name = function_name
+        self.method = method
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.statements = 0
+        self.rows = 0
+        self.slow_queries: List[Dict[str, Any]] = []
+
+    def add(self, name: str, elapsed_ms: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed_ms
+
+    def record_query(self, query: Any, elapsed_ms: float, rows: int) -> None:
+        self.add('sql', elapsed_ms)
+        self.statements += 1
+        self.rows += max(rows, 0)
+        if elapsed_ms >= SLOW_QUERY_MS and len(self.slow_queries) < MAX_SLOW_QUERIES:
+            text = query.decode('utf-8', 'replace') if isinstance(query, bytes) else str(query)
+            self.slow_queries.append({'ms': round(elapsed_ms, 2), 'sql': ' '.join(text.split())[:300]})
+
+    def server_timing(self, total_ms: float) -> str:
+        parts = [f'{name};dur={ms:.2f}' for name, ms in self.phases.items() if name != 'sql']
+        if self.statements:
+            parts.append(f'sql;dur={self.phases.get("sql", 0.0):.2f};desc="{self.statements} statements, {self.rows} rows"')
+        parts.append(f'total;dur={total_ms:.2f}')
+        return ', '.join(parts)
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, (time.perf_counter() - started) * 1000)
+
+
+def traced_cursor(factory: type) -> type:
+    '''Подкласс курсора, который замеряет каждый execute/executemany в текущей трассе'''
+    if factory not in _traced_cursors:
+        def execute(self, query, vars=None):
+            started = time.perf_counter()
+            try:
+                return factory.execute(self, query, vars)
+            finally:
+                trace = _current.get()
+                if trace is not None:
+                    trace.record_query(query, (time.perf_counter() - started) * 1000, self.rowcount)
+
+        def executemany(self, query, vars_list):
+            started = time.perf_counter()
+            try:
+                return factory.executemany(self, query, vars_list)
+            finally:
+                trace = _current.get()
+                if trace is not None:
+                    trace.record_query(query, (time.perf_counter() - started) * 1000, self.rowcount)
+
+        _traced_cursors[factory] = type(f'Traced{factory.__name__}', (factory,), {
+            'execute': execute, 'executemany': executemany
+        })
+    return _traced_cursors[factory]
+
+
+def traced(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable[[Dict[str, Any], Any], Dict[str, Any]]:
+    '''
+    Декоратор handler: открывает трассу на вызов, пишет лог и при TRACE_SERVER_TIMING=1 добавляет Server-Timing.
+    Ответ handler не изменяется (он может быть заранее собранной константой), возвращается копия.
+    '''
+
+    @functools.wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        if SAMPLE_RATE <= 0 or (SAMPLE_RATE < 1 and random.random() >= SAMPLE_RATE):
+            return handler(event, context)
+        trace = Trace(
+            getattr(context, 'request_id', ''),
+            getattr(context, 'function_name', ''),
+            event.get('httpMethod', '')
+        )
+        token = _current.set(trace)
+        try:
+            response = handler(event, context)
+        except BaseException:
+            _current.reset(token)
+            if LOG_ENABLED:
+                log(trace, None, (time.perf_counter() - trace.started) * 1000)
+            raise
+        _current.reset(token)
+        total_ms = (time.perf_counter() - trace.started) * 1000
+        if LOG_ENABLED:
+            log(trace, response, total_ms)
+        if not SERVER_TIMING:
+            return response
+
+        headers = dict(response.get('headers') or {})
+        headers['Server-Timing'] = trace.server_timing(total_ms)
+        exposed = headers.get('Access-Control-Expose-Headers')
+        headers['Access-Control-Expose-Headers'] = f'{exposed}, Server-Timing' if exposed else 'Server-Timing'
+        return {**response, 'headers': headers}
+
+    return wrapper
+
+
+def log(trace: Trace, response: Optional[Dict[str, Any]], total_ms: float) -> None:
+    record = {
+        'type': 'trace',
+        'request_id': trace.request_id,
+        'function': trace.function_name,
+        'method': trace.method,
+        'status': response.get('statusCode') if response is not None else 500,
+        'duration_ms': round(total_ms, 2),
+        'phases': {name: round(ms, 2) for name, ms in trace.phases.items()},
+        'sql_statements': trace.statements,
+        'sql_rows': trace.rows
+    }
+    if trace.slow_queries:
+        record['slow_queries'] = trace.slow_queries
+    sys.stdout.write(json.dumps(record, ensure_ascii=False) + '\n')
@@ -0,0 +1,72 @@
+'''
+Профиль холодного старта: время импорта index.py каждой функции.
+
+Запуск: python benchmarks/import_profile.py [--budget-ms 150]
+Каждая функция импортируется в отдельном процессе с `python -X importtime`.
+Скрипт завершается с кодом 1, если тяжёлый модуль (psycopg2, smtplib, email.mime)
+снова попал в импорт верхнего уровня или суммарное время импорта вышло за бюджет.
+'''
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+
+FORBIDDEN_IMPORTS: Dict[str, Tuple[str, ...]] = {
+    'products': ('psycopg2',),
+    'orders': ('psycopg2',),
+    'email-dispatcher': ('psycopg2', 'urllib.request'),
+    'send-email': ('smtplib', 'email.mime'),
+}
+
+
+def profile_imports(name: str) -> Tuple[float, List[Tuple[str, float]]]:
+    '''Возвращает суммарное время импорта index (мс) и список (модуль, собственное время мс)'''
+    env = {**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'}
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import index'],
+        cwd=BACKEND_DIR / name, env=env, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f'{name}: import failed\n{completed.stderr}')
+    modules = []
+    total_ms = 0.0
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = [part.strip() for part in line[len('import time:'):].split('|')]
+        modules.append((module.strip(), int(self_us) / 1000))
+        if module.strip() == 'index':
+            total_ms = int(cumulative_us) / 1000
+    return total_ms, modules
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget-ms', type=float, default=150.0, help='бюджет на импорт index одной функции')
+    parser.add_argument('--top', type=int, default=5, help='сколько самых медленных модулей показать')
+    args = parser.parse_args()
+
+    failed = False
+    for name, forbidden in FORBIDDEN_IMPORTS.items():
+        total_ms, modules = profile_imports(name)
+        print(f'{name:<18} import index: {total_ms:7.2f}ms')
+        for module, self_ms in sorted(modules, key=lambda item: item[1], reverse=True)[:args.top]:
+            print(f'    {module:<40} {self_ms:7.2f}ms')
+        loaded = {module for module, _ in modules}
+        for prefix in forbidden:
+            offenders = sorted(module for module in loaded if module == prefix or module.startswith(prefix + '.'))
+            if offenders:
+                failed = True
+                print(f'    FAIL: {", ".join(offenders)} imported at module level')
+        if total_ms > args.budget_ms:
+            failed = True
+            print(f'    FAIL: import time over budget ({args.budget_ms:.0f}ms)')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+'''
+Нагрузочный прогон функций backend/ по сценариям из их tests.json.
+
+Создаёт одноразовую базу, накатывает db_migrations, засевает её данными нужного объёма,
+поднимает локальный SMTP-приёмник и HTTP-обёртку над send-email (для email-dispatcher),
+после чего гоняет смешанную конкурентную нагрузку, вызывая handler напрямую.
+
+Пример:
+    python benchmarks/loadtest.py --dsn postgresql://postgres@localhost/postgres \\
+        --products 10000 --orders 1000000 --requests 5000 --concurrency 8 \\
+        --baseline benchmarks/baseline.json
+
+Отчёт: p50/p95/p99, пропускная способность и число SQL-запросов на вызов по каждому сценарию.
+С --baseline прогон падает (код 1), если p95 или число запросов выросли сильнее --tolerance;
+--save-baseline записывает текущие результаты как новый эталон.
+'''
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+from pool_latency import BACKEND_DIR, Context, load_function
+from smtp_sink import SmtpSink
+
+MIGRATIONS_DIR = BACKEND_DIR.parent / 'db_migrations'
+FUNCTIONS = ('products', 'orders', 'send-email', 'email-dispatcher')
+# Телефон сценария "Customer order history" из orders/tests.json: им засевается каждый 1000-й заказ
+HISTORY_PHONE = '+79991234567'
+REPORT_MAX_SPAN_DAYS = 365
+
+SEED_SQL = '''
+INSERT INTO products (name, slug, description, price, old_price, category_id, image_url, badge, sizes, size_range)
+SELECT
+    'Товар ' || g,
+    'bench-product-' || g,
+    (ARRAY['Элегантное платье', 'Романтичная блуза', 'Удобные брюки', 'Лёгкая туника', 'Деловой костюм', 'Уютный кардиган'])[1 + g %% 6]
+        || ' из коллекции ' || g %% 97,
+    1000 + (g * 37) %% 9000,
+    CASE WHEN g %% 4 = 0 THEN 2000 + (g * 37) %% 9000 END,
+    1 + g %% 6,
+    '',
+    (ARRAY[NULL, 'ХИТ', 'NEW', 'SALE'])[1 + g %% 4],
+    (46 + 2 * (g %% 3)) || '-' || (58 + 2 * (g %% 4)),
+    int4range(46 + 2 * (g %% 3), 58 + 2 * (g %% 4), '[]')
+FROM generate_series(1, %(products)s) AS g;
+
+INSERT INTO orders (customer_name, customer_phone, customer_email, delivery_address, total_amount,
+                    status, payment_method, delivery_method, comment, created_at, updated_at)
+SELECT
+    'Покупатель ' || g,
+    CASE WHEN g %% 1000 = 0 THEN %(history_phone)s ELSE '+7999' || lpad((g %% 10000000)::text, 7, '0') END,
+    'buyer' || g || '@example.test',
+    'Москва, ул. Нагрузочная, ' || g %% 500,
+    0,
+    (ARRAY['new', 'processing', 'shipped', 'delivered', 'cancelled'])[1 + g %% 5],
+    'card',
+    'courier',
+    CASE WHEN g %% 3 = 0 THEN 'Позвонить заранее' END,
+    CURRENT_TIMESTAMP - make_interval(secs => g * 30),
+    CURRENT_TIMESTAMP - make_interval(secs => g * 30)
+FROM generate_series(1, %(orders)s) AS g;
+
+INSERT INTO customers (name, phone, email, address, phone_normalized)
+SELECT DISTINCT ON (normalize_phone(customer_phone))
+    customer_name, customer_phone, customer_email, delivery_address, normalize_phone(customer_phone)
+FROM orders
+WHERE customer_id IS NULL
+ORDER BY normalize_phone(customer_phone), created_at DESC
+ON CONFLICT (phone_normalized) DO NOTHING;
+
+INSERT INTO order_items (order_id, product_id, product_name, product_price, size, quantity, subtotal)
+SELECT o.id, p.id, p.name, p.price, '52', 1 + n %% 2, p.price * (1 + n %% 2)
+FROM orders o
+CROSS JOIN LATERAL generate_series(1, 1 + o.id %% 3) AS n
+JOIN products p ON p.id = 1 + (o.id * 7 + n) %% %(product_count)s;
+
+UPDATE orders o SET total_amount = s.total, customer_id = c.id
+FROM (SELECT order_id, sum(subtotal) AS total FROM order_items GROUP BY order_id) s, customers c
+WHERE s.order_id = o.id AND c.phone_normalized = normalize_phone(o.customer_phone);
+
+UPDATE catalog_version SET version = version + 1;
+'''
+
+
+def run_migrations(dsn: str) -> None:
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        for path in sorted(MIGRATIONS_DIR.glob('V*.sql'), key=lambda p: int(p.name[1:].split('__')[0])):
+            cursor.execute(path.read_text(encoding='utf-8'))
+    conn.close()
+
+
+def seed(dsn: str, products: int, orders: int) -> Optional[Tuple[date, date]]:
+    '''Засевает базу; возвращает первый и последний день созданных заказов (None, если заказов нет)'''
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT count(*) FROM products')
+        product_count = cursor.fetchone()[0] + products
+        cursor.execute(SEED_SQL, {
+            'products': products, 'orders': orders, 'product_count': product_count, 'history_phone': HISTORY_PHONE
+        })
+        cursor.execute('SELECT min(created_at)::date, max(created_at)::date FROM orders')
+        first_day, last_day = cursor.fetchone()
+    conn.commit()
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('VACUUM ANALYZE')
+    conn.close()
+    return (first_day, last_day) if first_day is not None else None
+
+
+def create_database(admin_dsn: str, name: str) -> str:
+    conn = psycopg2.connect(admin_dsn)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f'CREATE DATABASE "{name}"')
+    conn.close()
+    params = psycopg2.extensions.parse_dsn(admin_dsn)
+    params['dbname'] = name
+    return psycopg2.extensions.make_dsn(**params)
+
+
+def drop_database(admin_dsn: str, name: str) -> None:
+    conn = psycopg2.connect(admin_dsn)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+    conn.close()
+
+
+class QueryCounter(threading.local):
+    count = 0
+
+
+query_counter = QueryCounter()
+_counting_factories: Dict[type, type] = {}
+
+
+def counting_factory(factory: type) -> type:
+    '''Подкласс курсора, считающий execute/executemany в текущем потоке'''
+    if factory not in _counting_factories:
+        def execute(self, query, vars=None):
+            query_counter.count += 1
+            return factory.execute(self, query, vars)
+
+        def executemany(self, query, vars_list):
+            query_counter.count += 1
+            return factory.executemany(self, query, vars_list)
+
+        _counting_factories[factory] = type(f'Counting{factory.__name__}', (factory,), {
+            'execute': execute, 'executemany': executemany
+        })
+    return _counting_factories[factory]
+
+
+def instrument(module: Any) -> None:
+    '''Подменяет фабрику соединений в пуле функции на считающую запросы'''
+    if not hasattr(module, 'db'):
+        return
+    base = module.db.connection_class()
+
+    class CountingConnection(base):
+        def cursor(self, *args, **kwargs):
+            kwargs['cursor_factory'] = counting_factory(kwargs.get('cursor_factory') or self.cursor_factory)
+            return super().cursor(*args, **kwargs)
+
+    module.db._pool._connect = lambda: psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=CountingConnection)
+
+
+def serve_function(module: Any) -> ThreadingHTTPServer:
+    '''HTTP-обёртка над handler функции, чтобы другие функции могли звать её по URL'''
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args: Any) -> None:
+            pass
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get('Content-Length') or 0)
+            response = module.handler({
+                'httpMethod': 'POST',
+                'headers': dict(self.headers),
+                'body': self.rfile.read(length).decode('utf-8')
+            }, Context())
+            body = response.get('body', '').encode('utf-8')
+            self.send_response(response['statusCode'])
+            for key, value in (response.get('headers') or {}).items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_scenarios(modules: Dict[str, Any],
+                   seeded_days: Optional[Tuple[date, date]]) -> List[Tuple[str, Any, Dict[str, Any], int]]:
+    '''Сценарии из tests.json; диапазон отчётов (report=...) заменяется днями засеянных заказов'''
+    scenarios = []
+    for name, module in modules.items():
+        tests = json.loads((BACKEND_DIR / name / 'tests.json').read_text(encoding='utf-8'))['tests']
+        for test in tests:
+            url = urllib.parse.urlsplit(test.get('path', '/'))
+            event: Dict[str, Any] = {
+                'httpMethod': test['method'],
+                'headers': test.get('headers') or {},
+                'queryStringParameters': dict(urllib.parse.parse_qsl(url.query)) or None
+            }
+            query = event['queryStringParameters']
+            if query and query.get('report') and seeded_days:
+                first_day, last_day = seeded_days
+                query['to'] = (last_day + timedelta(days=1)).isoformat()
+                query['from'] = max(first_day, last_day - timedelta(days=REPORT_MAX_SPAN_DAYS - 1)).isoformat()
+            if 'body' in test:
+                body = test['body']
+                event['body'] = body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)
+            scenarios.append((f'{name}: {test["name"]}', module, event, test.get('expectedStatus', 200)))
+    return scenarios
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_load(scenarios: List[Tuple[str, Any, Dict[str, Any], int]], requests: int,
+             concurrency: int) -> Tuple[Dict[str, Dict[str, Any]], float]:
+    samples: Dict[str, List[Tuple[float, int, bool]]] = {label: [] for label, _, _, _ in scenarios}
+    lock = threading.Lock()
+    plan = [random.choice(scenarios) for _ in range(requests)]
+
+    def call(scenario: Tuple[str, Any, Dict[str, Any], int]) -> None:
+        label, module, event, expected_status = scenario
+        query_counter.count = 0
+        started = time.perf_counter()
+        try:
+            status = module.handler(dict(event), Context())['statusCode']
+        except Exception:
+            status = 599
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            samples[label].append((elapsed, query_counter.count, status == expected_status))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, plan))
+    wall = time.perf_counter() - started
+
+    report = {}
+    for label, rows in samples.items():
+        if not rows:
+            continue
+        latencies = sorted(row[0] for row in rows)
+        report[label] = {
+            'requests': len(rows),
+            'errors': sum(1 for row in rows if not row[2]),
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'throughput_rps': round(len(rows) / wall, 1),
+            'queries_per_request': round(statistics.mean(row[1] for row in rows), 2)
+        }
+    return report, wall
+
+
+def compare(report: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float) -> List[str]:
+    regressions = []
+    for label, current in report.items():
+        reference = baseline.get(label)
+        if reference is None:
+            continue
+        if current['p95_ms'] > reference['p95_ms'] * (1 + tolerance):
+            regressions.append(f'{label}: p95 {current["p95_ms"]}ms > baseline {reference["p95_ms"]}ms')
+        if current['queries_per_request'] > reference['queries_per_request']:
+            regressions.append(
+                f'{label}: {current["queries_per_request"]} queries/request > baseline {reference["queries_per_request"]}'
+            )
+        if current['errors'] > reference.get('errors', 0):
+            regressions.append(f'{label}: {current["errors"]} errors > baseline {reference.get("errors", 0)}')
+    return regressions
+
+
+def print_report(report: Dict[str, Dict[str, Any]], wall: float) -> None:
+    print(f'{"scenario":<48} {"n":>6} {"err":>4} {"p50":>9} {"p95":>9} {"p99":>9} {"rps":>8} {"q/req":>6}')
+    for label, row in sorted(report.items()):
+        print(f'{label:<48} {row["requests"]:>6} {row["errors"]:>4} {row["p50_ms"]:>8.2f}m {row["p95_ms"]:>8.2f}m '
+              f'{row["p99_ms"]:>8.2f}m {row["throughput_rps"]:>8.1f} {row["queries_per_request"]:>6.2f}')
+    total = sum(row['requests'] for row in report.values())
+    print(f'total: {total} requests in {wall:.2f}s ({total / wall:.1f} rps)')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', required=True, help='DSN сервера, на котором можно создать одноразовую базу')
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--baseline', type=Path)
+    parser.add_argument('--save-baseline', type=Path)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--keep', action='store_true', help='не удалять базу после прогона')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    database = f'vivass_bench_{os.getpid()}'
+    dsn = create_database(args.dsn, database)
+    smtp_sink = SmtpSink().start()
+    modules: Dict[str, Any] = {}
+    try:
+        print(f'migrating and seeding {database}: {args.products} products, {args.orders} orders')
+        run_migrations(dsn)
+        seeded_days = seed(dsn, args.products, args.orders)
+
+        os.environ.update({
+            'DATABASE_URL': dsn,
+            'DB_POOL_MAX_SIZE': str(args.concurrency),
+            'SMTP_HOST': '127.0.0.1',
+            'SMTP_PORT': str(smtp_sink.port),
+            'SMTP_USER': 'bench@example.test',
+            'SMTP_PASSWORD': 'bench',
+            'SMTP_STARTTLS': '0',
+            'ADMIN_EMAIL': 'admin@example.test',
+            'RATE_LIMIT_IP_BURST': '1000000000',
+            'RATE_LIMIT_PHONE_BURST': '1000000000',
+            'TRACE_LOG': '0'
+        })
+        send_email = load_function('send-email')
+        email_server = serve_function(send_email)
+        os.environ['SEND_EMAIL_URL'] = f'http://127.0.0.1:{email_server.server_address[1]}/'
+
+        modules['send-email'] = send_email
+        for name in FUNCTIONS:
+            if name not in modules:
+                modules[name] = load_function(name)
+            instrument(modules[name])
+
+        report, wall = run_load(load_scenarios(modules, seeded_days), args.requests, args.concurrency)
+        print_report(report, wall)
+        print(f'smtp sink received {smtp_sink.delivered} messages')
+        email_server.shutdown()
+
+        if args.save_baseline:
+            args.save_baseline.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+        if args.baseline:
+            regressions = compare(report, json.loads(args.baseline.read_text(encoding='utf-8')), args.tolerance)
+            for line in regressions:
+                print(f'REGRESSION {line}')
+            if regressions:
+                return 1
+        return 0
+    finally:
+        smtp_sink.shutdown()
+        for module in modules.values():
+            if hasattr(module, 'db'):
+                module.db._pool.close_all()
+        if not args.keep:
+            drop_database(args.dsn, database)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+'''
+Сравнение задержки запроса с пулом соединений и без него.
+
+Запуск: DATABASE_URL=postgresql://... python benchmarks/pool_latency.py [--requests 200]
+Режим "cold" закрывает пул после каждого вызова, то есть повторяет прежнее
+поведение (новое соединение на каждый запрос); режим "pooled" переиспользует соединения.
+'''
+import argparse
+import importlib.util
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+
+
+class Context:
+    request_id = 'bench'
+    function_name = 'bench'
+
+
+def load_function(name: str) -> Any:
+    '''Загружает index.py функции вместе с её локальными модулями, не смешивая их с другими функциями'''
+    function_dir = BACKEND_DIR / name
+    local_modules = [path.stem for path in function_dir.glob('*.py') if path.stem != 'index']
+    for module_name in local_modules:
+        sys.modules.pop(module_name, None)
+    sys.path.insert(0, str(function_dir))
+    try:
+        spec = importlib.util.spec_from_file_location(f'{name.replace("-", "_")}_index', function_dir / 'index.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(function_dir))
+        for module_name in local_modules:
+            sys.modules.pop(module_name, None)
+    return module
+
+
+def measure(call: Callable[[], Dict[str, Any]], after: Callable[[], None], requests: int) -> List[float]:
+    timings = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = call()
+        timings.append((time.perf_counter() - started) * 1000)
+        if response['statusCode'] >= 400:
+            raise RuntimeError(f'unexpected response: {response}')
+        after()
+    return timings
+
+
+def report(label: str, timings: List[float]) -> None:
+    ordered = sorted(timings)
+    p95 = ordered[int(len(ordered) * 0.95) - 1]
+    print(f'{label:<24} mean={statistics.mean(ordered):7.2f}ms  p50={statistics.median(ordered):7.2f}ms  p95={p95:7.2f}ms')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    scenarios = {
+        'products GET': (load_function('products'), {'httpMethod': 'GET', 'queryStringParameters': {}}),
+        'orders GET': (load_function('orders'), {'httpMethod': 'GET', 'queryStringParameters': {}}),
+    }
+
+    for label, (module, event) in scenarios.items():
+        call = lambda: module.handler(event, Context())
+        pool = module.db._pool
+        call()
+        report(f'{label} (cold)', measure(call, pool.close_all, args.requests))
+        call()
+        report(f'{label} (pooled)', measure(call, lambda: None, args.requests))
+        pool.close_all()
+
+
+if __name__ == '__main__':
+    main()
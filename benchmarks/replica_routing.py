@@ -0,0 +1,138 @@
+'''
+Проверка маршрутизации чтений на реплику (DATABASE_READ_URL) на двух локальных Postgres.
+
+Подготовка реплики потоковой репликацией (primary на 5432, реплика на 5433):
+    initdb -D /tmp/pg-primary && echo "wal_level = replica" >> /tmp/pg-primary/postgresql.conf
+    pg_ctl -D /tmp/pg-primary -o "-p 5432" start
+    pg_basebackup -h localhost -p 5432 -D /tmp/pg-replica -R -X stream
+    pg_ctl -D /tmp/pg-replica -o "-p 5433" start
+
+Запуск:
+    python benchmarks/replica_routing.py --primary postgresql://postgres@localhost:5432/postgres \\
+        --replica postgresql://postgres@localhost:5433/postgres
+
+Скрипт создаёт одноразовую базу на primary (она реплицируется), накатывает миграции и проверяет:
+GET идут на реплику, заказ читается сразу после создания (с X-Read-After и без него),
+а при недоступной реплике GET уходят на primary. Код выхода 1, если проверка не прошла.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import psycopg2.extensions
+
+from loadtest import create_database, drop_database, run_migrations, seed
+from pool_latency import Context, load_function
+
+DEAD_DSN = 'postgresql://postgres@127.0.0.1:1/postgres?connect_timeout=1'
+
+
+def with_database(dsn: str, name: str) -> str:
+    params = psycopg2.extensions.parse_dsn(dsn)
+    params['dbname'] = name
+    return psycopg2.extensions.make_dsn(**params)
+
+
+def wait_for_replica(dsn: str, table: str, timeout: float = 30) -> None:
+    '''Ждёт, пока миграции доедут до реплики'''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            conn = psycopg2.connect(dsn)
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (table,))
+                if cursor.fetchone()[0]:
+                    conn.close()
+                    return
+            conn.close()
+        except psycopg2.OperationalError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f'replica did not receive {table} within {timeout}s')
+        time.sleep(0.5)
+
+
+def call(module: Any, method: str, params: Optional[Dict[str, str]] = None, body: Any = None,
+         headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    event = {'httpMethod': method, 'queryStringParameters': params or {}, 'headers': headers or {}}
+    if body is not None:
+        event['body'] = json.dumps(body)
+    return module.handler(event, Context())
+
+
+def served_by_replica(module: Any) -> bool:
+    return bool(module.db._read_pool._idle)
+
+
+def check(failures: List[str], label: str, ok: bool) -> None:
+    print(f'{"ok  " if ok else "FAIL"} {label}')
+    if not ok:
+        failures.append(label)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--primary', required=True)
+    parser.add_argument('--replica', required=True)
+    parser.add_argument('--keep', action='store_true', help='не удалять базу после проверки')
+    args = parser.parse_args()
+
+    database = f'vivass_replica_{os.getpid()}'
+    primary = create_database(args.primary, database)
+    replica = with_database(args.replica, database)
+    failures: List[str] = []
+    try:
+        run_migrations(primary)
+        seed(primary, 100, 0)
+        wait_for_replica(replica, 'email_outbox')
+        os.environ.update({
+            'DATABASE_URL': primary,
+            'DATABASE_READ_URL': replica,
+            'DB_REPLICA_CHECK_INTERVAL': '0',
+            'TRACE_LOG': '0'
+        })
+        products = load_function('products')
+        orders = load_function('orders')
+
+        response = call(products, 'GET')
+        check(failures, 'catalog GET served by replica', response['statusCode'] == 200 and served_by_replica(products))
+
+        response = call(orders, 'POST', body={
+            'customer_name': 'Реплика', 'customer_phone': '+79990000000',
+            'items': [{'product_id': 1, 'size': '52', 'quantity': 1}]
+        })
+        order_id = json.loads(response['body'])['order_id']
+        read_after = response['headers'].get('X-Read-After')
+        check(failures, 'order POST returns X-Read-After', bool(read_after))
+
+        response = call(orders, 'GET', {'id': str(order_id)}, headers={'X-Read-After': read_after})
+        check(failures, 'order GET with X-Read-After sees the new order', response['statusCode'] == 200)
+
+        response = call(orders, 'POST', body={
+            'customer_name': 'Реплика', 'customer_phone': '+79990000000',
+            'items': [{'product_id': 1, 'size': '52', 'quantity': 1}]
+        })
+        order_id = json.loads(response['body'])['order_id']
+        response = call(orders, 'GET', {'id': str(order_id)})
+        check(failures, 'order GET without X-Read-After sees the new order', response['statusCode'] == 200)
+
+        os.environ['DATABASE_READ_URL'] = DEAD_DSN
+        for module in (products, orders):
+            module.db._read_pool.close_all()
+        response = call(orders, 'GET')
+        check(failures, 'order list falls back to primary when replica is down',
+              response['statusCode'] == 200 and not orders.db._replica.available())
+        response = call(products, 'GET', {'limit': '5'})
+        check(failures, 'catalog falls back to primary when replica is down',
+              response['statusCode'] == 200 and not products.db._replica.available())
+    finally:
+        if not args.keep:
+            drop_database(args.primary, database)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
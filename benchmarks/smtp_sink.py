@@ -0,0 +1,64 @@
+'''
+Минимальный SMTP-сервер, принимающий и выбрасывающий письма.
+Нужен, чтобы send-email можно было гонять под нагрузкой без настоящего релея.
+Поддерживает EHLO, AUTH PLAIN/LOGIN (любые учётные данные), MAIL, RCPT, DATA, RSET, NOOP, QUIT.
+STARTTLS не объявляется, поэтому send-email запускается с SMTP_STARTTLS=0.
+'''
+import socketserver
+import threading
+from typing import Tuple
+
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: str) -> None:
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self) -> None:
+        self.reply('220 smtp-sink ready')
+        while True:
+            raw = self.rfile.readline()
+            if not raw:
+                return
+            command = raw.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.wfile.write(b'250-smtp-sink\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n')
+            elif verb == 'HELO':
+                self.reply('250 smtp-sink')
+            elif verb == 'AUTH':
+                parts = command.split()
+                if len(parts) >= 2 and parts[1].upper() == 'LOGIN':
+                    for _ in range(2 if len(parts) == 2 else 1):
+                        self.reply('334 VXNlcm5hbWU6')
+                        self.rfile.readline()
+                self.reply('235 authenticated')
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                    pass
+                self.server.delivered += 1
+                self.reply('250 queued')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int] = ('127.0.0.1', 0)) -> None:
+        super().__init__(address, _SinkHandler)
+        self.delivered = 0
+
+    def start(self) -> 'SmtpSink':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
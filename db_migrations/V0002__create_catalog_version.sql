@@ -0,0 +1,9 @@
+-- Версия каталога: увеличивается при каждом изменении товаров,
+-- по ней инвалидируется кэш каталога и строится ETag
+CREATE TABLE catalog_version (
+    id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO catalog_version (id, version) VALUES (1, 1);
@@ -0,0 +1,11 @@
+-- Полнотекстовый поиск по товарам (русская морфология) и нечёткий поиск по названию
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE products ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('russian', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('russian', coalesce(description, '')), 'B')
+    ) STORED;
+
+CREATE INDEX idx_products_search ON products USING GIN (search_vector);
+CREATE INDEX idx_products_name_trgm ON products USING GIN (name gin_trgm_ops);
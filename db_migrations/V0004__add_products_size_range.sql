@@ -0,0 +1,12 @@
+-- Диапазон размеров товара в виде int4range для индексируемого фильтра по размеру
+ALTER TABLE products ADD COLUMN size_range int4range;
+
+UPDATE products
+SET size_range = int4range(
+    split_part(sizes, '-', 1)::int,
+    coalesce(nullif(split_part(sizes, '-', 2), ''), split_part(sizes, '-', 1))::int,
+    '[]'
+)
+WHERE sizes ~ '^\d+(-\d+)?$';
+
+CREATE INDEX idx_products_size_range ON products USING GIST (size_range);
@@ -0,0 +1,4 @@
+-- Составные индексы под постраничную выдачу по ключу (created_at, id)
+CREATE INDEX idx_orders_created_id ON orders (created_at DESC, id DESC);
+CREATE INDEX idx_orders_status_created_id ON orders (status, created_at DESC, id DESC);
+CREATE INDEX idx_products_active_created_id ON products (created_at DESC, id DESC) WHERE is_active = true;
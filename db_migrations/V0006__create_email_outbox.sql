@@ -0,0 +1,18 @@
+-- Очередь исходящих писем: пишется в одной транзакции с заказом,
+-- разбирается функцией email-dispatcher с повторами и отложенной доставкой
+CREATE TABLE email_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    order_id INTEGER REFERENCES orders(id),
+    to_email VARCHAR(255) NOT NULL,
+    subject VARCHAR(255) NOT NULL,
+    html TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP
+);
+
+CREATE INDEX idx_email_outbox_pending ON email_outbox (next_attempt_at) WHERE status = 'pending';
+CREATE INDEX idx_email_outbox_dead ON email_outbox (created_at) WHERE status = 'dead';
@@ -0,0 +1,12 @@
+-- Ключи идемпотентности POST /orders: повтор запроса с тем же Idempotency-Key
+-- получает сохранённый ответ вместо нового заказа; просроченные ключи удаляются пачками
+CREATE TABLE idempotency_keys (
+    key VARCHAR(255) PRIMARY KEY,
+    request_hash CHAR(64) NOT NULL,
+    status_code INTEGER NOT NULL,
+    response JSONB NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX idx_idempotency_keys_expires ON idempotency_keys (expires_at);
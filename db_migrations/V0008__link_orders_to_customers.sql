@@ -0,0 +1,33 @@
+-- Покупатели дедуплицируются по нормализованному телефону (только цифры, 8XXXXXXXXXX и
+-- 10-значные номера приводятся к 7XXXXXXXXXX); заказы ссылаются на покупателя через customer_id
+CREATE FUNCTION normalize_phone(phone TEXT) RETURNS TEXT
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT CASE
+        WHEN length(digits) = 11 AND left(digits, 1) = '8' THEN '7' || substr(digits, 2)
+        WHEN length(digits) = 10 THEN '7' || digits
+        ELSE digits
+    END
+    FROM (SELECT regexp_replace(phone, '\D', '', 'g') AS digits) s
+$$;
+
+ALTER TABLE customers ADD COLUMN phone_normalized VARCHAR(20);
+ALTER TABLE customers ADD COLUMN updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+UPDATE customers SET phone_normalized = normalize_phone(phone);
+CREATE UNIQUE INDEX idx_customers_phone_normalized ON customers (phone_normalized);
+
+INSERT INTO customers (name, phone, email, address, phone_normalized)
+SELECT DISTINCT ON (normalize_phone(customer_phone))
+    customer_name, customer_phone, customer_email, delivery_address, normalize_phone(customer_phone)
+FROM orders
+WHERE customer_id IS NULL AND normalize_phone(customer_phone) <> ''
+ORDER BY normalize_phone(customer_phone), created_at DESC
+ON CONFLICT (phone_normalized) DO NOTHING;
+
+UPDATE orders o
+SET customer_id = c.id
+FROM customers c
+WHERE o.customer_id IS NULL AND c.phone_normalized = normalize_phone(o.customer_phone);
+
+ALTER TABLE customers ALTER COLUMN phone_normalized SET NOT NULL;
+
+CREATE INDEX idx_orders_customer_created ON orders (customer_id, created_at DESC, id DESC);
@@ -0,0 +1,161 @@
+-- Дневные агрегаты продаж для отчётов: order_stats по (день, статус, категория) и
+-- order_product_stats по (день, статус, товар). День - дата создания заказа.
+-- category_id = 0 - итог по всем категориям (заказ считается один раз), -1 - позиции без категории.
+-- Агрегаты поддерживаются триггерами: вставка позиций добавляет их в корзину статуса заказа,
+-- смена статуса (или даты) заказа переносит его суммы из старой корзины в новую.
+-- Пересчёт диапазона дней: SELECT rebuild_order_stats('2024-01-01', '2024-12-31');
+
+-- Категория товара на момент продажи, чтобы перенос по статусам не зависел от поздних правок товара
+ALTER TABLE order_items ADD COLUMN category_id INTEGER;
+
+UPDATE order_items i
+SET category_id = p.category_id
+FROM products p
+WHERE p.id = i.product_id;
+
+CREATE FUNCTION order_items_set_category() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF NEW.category_id IS NULL AND NEW.product_id IS NOT NULL THEN
+        SELECT category_id INTO NEW.category_id FROM products WHERE id = NEW.product_id;
+    END IF;
+    RETURN NEW;
+END
+$$;
+
+CREATE TRIGGER order_items_set_category
+BEFORE INSERT ON order_items
+FOR EACH ROW EXECUTE FUNCTION order_items_set_category();
+
+CREATE TABLE order_stats (
+    day DATE NOT NULL,
+    status VARCHAR(50) NOT NULL,
+    category_id INTEGER NOT NULL,
+    orders INTEGER NOT NULL DEFAULT 0,
+    units INTEGER NOT NULL DEFAULT 0,
+    revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, status, category_id)
+);
+
+CREATE TABLE order_product_stats (
+    day DATE NOT NULL,
+    status VARCHAR(50) NOT NULL,
+    product_id INTEGER NOT NULL,
+    units INTEGER NOT NULL DEFAULT 0,
+    revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, status, product_id)
+);
+
+CREATE INDEX idx_order_stats_category_day ON order_stats (category_id, day);
+
+-- Вклад позиций заказов в агрегаты: sign = 1 добавить, -1 вычесть
+CREATE TYPE order_stats_delta AS (
+    day DATE,
+    status VARCHAR(50),
+    sign INTEGER,
+    order_id INTEGER,
+    product_id INTEGER,
+    category_id INTEGER,
+    quantity INTEGER,
+    subtotal DECIMAL(10, 2)
+);
+
+CREATE FUNCTION apply_order_stats_delta(delta order_stats_delta[]) RETURNS void
+LANGUAGE sql AS $$
+    INSERT INTO order_stats (day, status, category_id, orders, units, revenue)
+    SELECT
+        day, status,
+        CASE WHEN GROUPING(category_id) = 1 THEN 0 ELSE coalesce(category_id, -1) END,
+        count(DISTINCT order_id) FILTER (WHERE sign > 0) - count(DISTINCT order_id) FILTER (WHERE sign < 0),
+        sum(sign * quantity),
+        sum(sign * subtotal)
+    FROM unnest(delta)
+    GROUP BY GROUPING SETS ((day, status, category_id), (day, status))
+    ON CONFLICT (day, status, category_id) DO UPDATE SET
+        orders = order_stats.orders + EXCLUDED.orders,
+        units = order_stats.units + EXCLUDED.units,
+        revenue = order_stats.revenue + EXCLUDED.revenue;
+
+    INSERT INTO order_product_stats (day, status, product_id, units, revenue)
+    SELECT day, status, coalesce(product_id, 0), sum(sign * quantity), sum(sign * subtotal)
+    FROM unnest(delta)
+    GROUP BY day, status, coalesce(product_id, 0)
+    ON CONFLICT (day, status, product_id) DO UPDATE SET
+        units = order_product_stats.units + EXCLUDED.units,
+        revenue = order_product_stats.revenue + EXCLUDED.revenue;
+$$;
+
+CREATE FUNCTION order_items_stats() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM apply_order_stats_delta(ARRAY(
+        SELECT ROW(o.created_at::date, coalesce(o.status, 'new'), 1,
+            i.order_id, i.product_id, i.category_id, i.quantity, i.subtotal)::order_stats_delta
+        FROM new_items i
+        JOIN orders o ON o.id = i.order_id
+    ));
+    RETURN NULL;
+END
+$$;
+
+CREATE FUNCTION orders_stats() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM apply_order_stats_delta(ARRAY(
+        WITH moved AS (
+            SELECT n.id,
+                o.created_at::date AS old_day, coalesce(o.status, 'new') AS old_status,
+                n.created_at::date AS new_day, coalesce(n.status, 'new') AS new_status
+            FROM old_orders o
+            JOIN new_orders n ON n.id = o.id
+            WHERE o.status IS DISTINCT FROM n.status OR o.created_at::date IS DISTINCT FROM n.created_at::date
+        )
+        SELECT ROW(m.old_day, m.old_status, -1,
+            i.order_id, i.product_id, i.category_id, i.quantity, i.subtotal)::order_stats_delta
+        FROM moved m
+        JOIN order_items i ON i.order_id = m.id
+        UNION ALL
+        SELECT ROW(m.new_day, m.new_status, 1,
+            i.order_id, i.product_id, i.category_id, i.quantity, i.subtotal)::order_stats_delta
+        FROM moved m
+        JOIN order_items i ON i.order_id = m.id
+    ));
+    RETURN NULL;
+END
+$$;
+
+CREATE TRIGGER order_items_stats
+AFTER INSERT ON order_items
+REFERENCING NEW TABLE AS new_items
+FOR EACH STATEMENT EXECUTE FUNCTION order_items_stats();
+
+CREATE TRIGGER orders_stats
+AFTER UPDATE ON orders
+REFERENCING OLD TABLE AS old_orders NEW TABLE AS new_orders
+FOR EACH STATEMENT EXECUTE FUNCTION orders_stats();
+
+-- Пересчёт агрегатов за диапазон дней (включительно) по одному дню за раз
+CREATE FUNCTION rebuild_order_stats(from_day DATE, to_day DATE) RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    stats_day DATE;
+BEGIN
+    LOCK TABLE order_stats, order_product_stats IN SHARE ROW EXCLUSIVE MODE;
+    DELETE FROM order_stats WHERE day BETWEEN from_day AND to_day;
+    DELETE FROM order_product_stats WHERE day BETWEEN from_day AND to_day;
+    FOR stats_day IN SELECT generate_series(from_day, to_day, interval '1 day')::date LOOP
+        PERFORM apply_order_stats_delta(ARRAY(
+            SELECT ROW(o.created_at::date, coalesce(o.status, 'new'), 1,
+                i.order_id, i.product_id, i.category_id, i.quantity, i.subtotal)::order_stats_delta
+            FROM orders o
+            JOIN order_items i ON i.order_id = o.id
+            WHERE o.created_at >= stats_day AND o.created_at < stats_day + 1
+        ));
+    END LOOP;
+END
+$$;
+
+SELECT rebuild_order_stats(
+    coalesce((SELECT min(created_at)::date FROM orders), CURRENT_DATE),
+    coalesce((SELECT max(created_at)::date FROM orders), CURRENT_DATE)
+);
@@ -0,0 +1,37 @@
+-- Общие для всех экземпляров функций token bucket для ограничения частоты записей
+-- (по IP клиента и телефону). Таблица UNLOGGED: после сбоя базы вёдра просто снова полные.
+-- Давно не использованные (а значит, полные) вёдра удаляются функциями пачками.
+CREATE UNLOGGED TABLE rate_limits (
+    key VARCHAR(100) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_rate_limits_updated ON rate_limits (updated_at);
+
+-- Пополняет ведро bucket по времени с прошлого обращения (rate жетонов в секунду, не больше burst)
+-- и забирает жетон, если он есть. remaining - жетонов в ведре после обращения.
+CREATE FUNCTION take_rate_limit_token(bucket VARCHAR, rate DOUBLE PRECISION, burst DOUBLE PRECISION)
+RETURNS TABLE (allowed BOOLEAN, remaining DOUBLE PRECISION)
+LANGUAGE plpgsql AS $$
+DECLARE
+    available DOUBLE PRECISION;
+    taken_at TIMESTAMP;
+BEGIN
+    INSERT INTO rate_limits (key, tokens, updated_at)
+    VALUES (bucket, burst, clock_timestamp())
+    ON CONFLICT (key) DO NOTHING;
+
+    SELECT r.tokens, r.updated_at INTO available, taken_at
+    FROM rate_limits r
+    WHERE r.key = bucket
+    FOR UPDATE;
+
+    available := least(burst, available + greatest(0, extract(epoch FROM clock_timestamp() - taken_at)) * rate);
+    allowed := available >= 1;
+    remaining := available - CASE WHEN allowed THEN 1 ELSE 0 END;
+
+    UPDATE rate_limits SET tokens = remaining, updated_at = clock_timestamp() WHERE key = bucket;
+    RETURN NEXT;
+END
+$$;
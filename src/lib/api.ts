@@ -0,0 +1,15 @@
+// Списки API отдаются страницами по ключу: идём по next_cursor, пока он есть
+export async function fetchAllPages<T>(url: string, key: string, limit = 100): Promise<T[]> {
+  const items: T[] = []
+  let cursor: string | null = null
+  do {
+    const pageUrl = new URL(url)
+    pageUrl.searchParams.set("limit", String(limit))
+    if (cursor) pageUrl.searchParams.set("cursor", cursor)
+    const response = await fetch(pageUrl.toString())
+    const data = await response.json()
+    items.push(...data[key])
+    cursor = data.next_cursor ?? null
+  } while (cursor)
+  return items
+}
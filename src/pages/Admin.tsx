@@ -9,6 +9,7 @@ import Icon from '@/components/ui/icon';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
 import { Dialog, DialogContent, DialogDescription, DialogHeader, DialogTitle, DialogTrigger } from '@/components/ui/dialog';
 import { Tabs, TabsContent, TabsList, TabsTrigger } from '@/components/ui/tabs';
+import { fetchAllPages } from '@/lib/api';
 
 const Admin = () => {
   const [activeTab, setActiveTab] = useState('products');
@@ -31,17 +32,13 @@ const Admin = () => {
 
   const fetchProducts = async () => {
     setLoading(true);
-    const response = await fetch('https://functions.poehali.dev/68a49b74-7604-4ba7-88e4-b850c9f8620e');
-    const data = await response.json();
-    setProducts(data.products);
+    setProducts(await fetchAllPages<any>('https://functions.poehali.dev/68a49b74-7604-4ba7-88e4-b850c9f8620e', 'products'));
     setLoading(false);
   };
 
   const fetchOrders = async () => {
     setLoading(true);
-    const response = await fetch('https://functions.poehali.dev/228e7b4d-7205-4b2b-b62d-481754385663');
-    const data = await response.json();
-    setOrders(data.orders);
+    setOrders(await fetchAllPages<any>('https://functions.poehali.dev/228e7b4d-7205-4b2b-b62d-481754385663', 'orders'));
     setLoading(false);
   };
 
@@ -145,28 +142,24 @@ const Admin = () => {
                             return;
                           }
                           
-                          let successCount = 0;
-                          let errorCount = 0;
-                          
-                          for (const item of items) {
-                            try {
-                              const response = await fetch('https://functions.poehali.dev/68a49b74-7604-4ba7-88e4-b850c9f8620e', {
-                                method: 'POST',
-                                headers: { 'Content-Type': 'application/json' },
-                                body: JSON.stringify(item)
-                              });
-                              
-                              if (response.ok) {
-                                successCount++;
-                              } else {
-                                errorCount++;
-                              }
-                            } catch (err) {
-                              errorCount++;
-                            }
+                          const response = await fetch('https://functions.poehali.dev/68a49b74-7604-4ba7-88e4-b850c9f8620e', {
+                            method: 'POST',
+                            headers: { 'Content-Type': 'application/x-ndjson' },
+                            body: items.map((item) => JSON.stringify(item)).join('\n')
+                          });
+                          const result = await response.json();
+
+                          if (!response.ok) {
+                            alert('Ошибка загрузки: ' + (result.error || response.status));
+                            setBulkLoading(false);
+                            return;
                           }
-                          
-                          alert(`Загружено: ${successCount}, Ошибок: ${errorCount}`);
+
+                          const errors = result.rejected
+                            .slice(0, 5)
+                            .map((item: { line: number; error: string }) => `строка ${item.line}: ${item.error}`)
+                            .join('\n');
+                          alert(`Загружено: ${result.created + result.updated}, Ошибок: ${result.rejected_count}` + (errors ? `\n${errors}` : ''));
                           setBulkData('');
                           setIsBulkUploadOpen(false);
                           fetchProducts();
@@ -5,6 +5,7 @@ import { Badge } from '@/components/ui/badge';
 import { Input } from '@/components/ui/input';
 import Icon from '@/components/ui/icon';
 import { Separator } from '@/components/ui/separator';
+import { fetchAllPages } from '@/lib/api';
 import {
   Sheet,
   SheetContent,
@@ -105,10 +106,9 @@ const Index = () => {
     
     const url = `https://functions.poehali.dev/68a49b74-7604-4ba7-88e4-b850c9f8620e?${params.toString()}`;
     
-    const response = await fetch(url);
-    const data = await response.json();
+    const pageProducts = await fetchAllPages<any>(url, 'products');
     
-    const formattedProducts = data.products.map((p: any) => ({
+    const formattedProducts = pageProducts.map((p: any) => ({
       id: p.id,
       name: p.name,
       price: p.price,